@@ -1,19 +1,103 @@
 import streamlit as st
 import os
 import sys
-import tempfile
 import io
+import time
+import threading
 
 # Import processors
+# Only the light modules are imported here; processor_cloud/exporter pull in
+# pandas, openpyxl and xlsxwriter and are imported on first use (see core())
 sys.path.append(os.path.join(os.path.dirname(__file__), 'core_logic'))
 try:
-    from processor_cloud import process_excel_cloud, process_excel_cloud_get_data
+    from jobs import JobManager
+    from uploads import UploadSpool
 except ImportError:
     sys.path.append(os.getcwd())
-    from core_logic.processor_cloud import process_excel_cloud, process_excel_cloud_get_data
+    from core_logic.jobs import JobManager
+    from core_logic.uploads import UploadSpool
 
 st.set_page_config(page_title="Excel Auto-Processing Tool", layout="wide")
 
+BUNDLED_TEMPLATE = os.path.join(os.path.dirname(__file__), "自动化工具模板.xlsx")
+
+def core():
+    """Import the processing modules (heavy, deferred until first analysis)."""
+    try:
+        import processor_cloud, exporter, template_plan
+    except ImportError:
+        from core_logic import processor_cloud, exporter, template_plan
+    return processor_cloud, exporter, template_plan
+
+@st.cache_resource
+def get_export_cache():
+    # Encoded workbooks keyed by group content, shared by all reruns/sessions
+    return core()[1].EncodedCache(max_bytes=256 * 1024 * 1024)
+
+@st.cache_resource
+def get_bundled_template():
+    # Read once per process instead of on every rerun, None if missing
+    try:
+        with open(BUNDLED_TEMPLATE, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+@st.cache_resource
+def prewarm_bundled_plan():
+    # Runs once per process after the first page is rendered: imports the
+    # processors and compiles the bundled template's plan in the background,
+    # so the first analysis of an unchanged template skips parsing
+    # (plans are cached by content hash)
+    data = get_bundled_template()
+
+    def warm():
+        try:
+            template_plan = core()[2]
+            if data is not None:
+                template_plan.load_template_plan(data)
+        except Exception as e:
+            print(f"Prewarm failed: {e}")
+
+    thread = threading.Thread(target=warm, name="sms-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource
+def get_link_registry():
+    # Every exported link, shared by all sessions (SMS_LINK_REGISTRY sets the file)
+    try:
+        from link_registry import LinkRegistry
+    except ImportError:
+        from core_logic.link_registry import LinkRegistry
+    try:
+        return LinkRegistry()
+    except Exception as e:
+        print(f"Link registry unavailable: {e}")
+        return None
+
+@st.cache_resource
+def get_job_manager():
+    # One background pool per server process, shared by all sessions
+    return JobManager(max_workers=2)
+
+STAGE_LABELS = {
+    "read_source": "读取源文件",
+    "read_template": "读取模板",
+    "fill": "填入短链",
+    "compute_content": "生成内容",
+    "filter": "过滤",
+    "check_links": "检查重复短链",
+    "group": "分组",
+    "segments": "计算短信条数",
+}
+
+def get_upload_spool():
+    # Large uploads go to a per-session temp dir, removed when the session ends
+    if "upload_spool" not in st.session_state or st.session_state.upload_spool.closed:
+        st.session_state.upload_spool = UploadSpool()
+    return st.session_state.upload_spool
+
 st.title("📊 Excel 自动化处理工具 (Cloud)")
 st.markdown("""
 ### 上传短链文件和初始模板文件，即可以根据文案类别自动聚合并分别导出短信模板
@@ -21,52 +105,144 @@ st.markdown("""
 
 # 1. Source File Upload
 st.header("1. 上传源文件 (Source)")
-uploaded_source = st.file_uploader("上传短链接平台导出的短链文件", type=["xlsx", "xls"], key="source")
+# Several exports of one task (or a ZIP of them) are merged in file name order
+uploaded_sources = st.file_uploader(
+    "上传短链接平台导出的短链文件 (可多选，或上传 ZIP)",
+    type=["xlsx", "xls", "csv", "parquet", "zip"],
+    accept_multiple_files=True,
+    key="source",
+)
 
 # 2. Template File Upload
 col_t1, col_t2 = st.columns([3, 1])
 with col_t1:
     st.header("2. 上传模板文件 (Template)")
-    uploaded_template = st.file_uploader("请上传模板文件", type=["xlsx", "xls"], key="template")
+    # Several templates (regions, festivals, A/B copy) share one read of the source
+    uploaded_templates = st.file_uploader(
+        "请上传模板文件 (可多选，每个模板单独分组导出)",
+        type=["xlsx", "xls"],
+        accept_multiple_files=True,
+        key="template",
+    )
 with col_t2:
     st.write("") # Spacer
     st.write("") # Spacer
-    # Read local template file to bytes
-    try:
-        # Use absolute path relative to this script
-        template_path = os.path.join(os.path.dirname(__file__), "自动化工具模板.xlsx")
-        with open(template_path, "rb") as f:
-            template_bytes = f.read()
-            
+    # Bundled template bytes, read once per process
+    template_bytes = get_bundled_template()
+    if template_bytes is not None:
         st.download_button(
             label="📄 点击下载模板\n(查看填写说明)",
             data=template_bytes,
             file_name="自动化工具模板.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
-    except FileNotFoundError:
+    else:
         st.warning("默认模板文件(自动化工具模板.xlsx)未找到")
 
 # Session State Initialization
 if 'processed_data' not in st.session_state:
     st.session_state.processed_data = None
 
+# Links exported by earlier campaigns: list them (default) or stop the analysis
+reject_reused = st.checkbox("短链已在以往活动中导出过时终止分析 (Reject reused links)", value=False)
+
 # Process Button (Step 1)
 if st.button("第一步：开始分析 (Analyze)", type="primary"):
-    if not uploaded_source:
+    if not uploaded_sources:
         st.error("请先上传源文件！")
-    elif not uploaded_template:
+    elif not uploaded_templates:
         st.error("请先上传模板文件！")
     else:
-        try:
-            with st.spinner("正在云端分析数据..."):
-                # Step 1: Get data map
-                data_map = process_excel_cloud_get_data(uploaded_source, uploaded_template)
-                st.session_state.processed_data = data_map
-                st.success(f"分析完成！共找到 {len(data_map)} 组数据。")
-        except Exception as e:
-            st.error(f"分析失败: {e}")
-            st.exception(e)
+        # A new analysis replaces the previous one, release its spooled files
+        previous_job = get_job_manager().get(st.session_state.get("analysis_job"))
+        if previous_job is not None:
+            previous_job.cancel()
+        spool = get_upload_spool()
+        spool.clear()
+
+        # Step 1: Get data map, as a background job that survives reruns
+        processor_cloud = core()[0]
+        sources = [spool.spool(uploaded) for uploaded in uploaded_sources]
+        templates = [spool.spool(uploaded) for uploaded in uploaded_templates]
+        source = sources[0] if len(sources) == 1 else sources
+        on_duplicate = "reject" if reject_reused else "flag"
+        if len(templates) == 1:
+            job = get_job_manager().submit(
+                processor_cloud.process_excel_cloud_get_data,
+                source,
+                templates[0],
+                expected_stages=len(processor_cloud.ANALYSIS_STAGES),
+                # A re-exported source with appended links only recomputes the new rows
+                previous=st.session_state.get("last_result"),
+                registry=get_link_registry(),
+                on_duplicate=on_duplicate,
+            )
+        else:
+            # Fan-out: groups are keyed (template, 文案) and files namespaced by template
+            job = get_job_manager().submit(
+                processor_cloud.process_excel_cloud_get_data_many,
+                source,
+                templates,
+                expected_stages=processor_cloud.fanout_stage_count(len(templates)),
+                registry=get_link_registry(),
+                on_duplicate=on_duplicate,
+            )
+        st.session_state.analysis_job = job.id
+        st.session_state.source_name = os.path.splitext(min(uploaded.name for uploaded in uploaded_sources))[0]
+        st.session_state.processed_data = None
+        st.session_state.confirmed_filenames = None
+        st.session_state.bundle_zip = None
+
+# Background analysis status
+if st.session_state.get('analysis_job'):
+    job = get_job_manager().get(st.session_state.analysis_job)
+    if job is None:
+        st.session_state.analysis_job = None
+    elif not job.finished:
+        # Fan-out stages are "<template>/<stage>"
+        template, _, stage = (job.stage or "").rpartition("/")
+        done_label = STAGE_LABELS.get(stage, "排队中") + (f" ({template})" if template else "")
+        st.progress(job.progress, text=f"正在云端分析数据... (已完成: {done_label})")
+        if st.button("取消分析 (Cancel)"):
+            job.cancel()
+        time.sleep(0.5)
+        st.rerun()
+    else:
+        st.session_state.analysis_job = None
+        get_job_manager().forget(job.id)
+        # The links and the template plan are in memory now, drop the spooled uploads
+        spool = st.session_state.get("upload_spool")
+        if spool is not None and not spool.closed:
+            spool.clear()
+        if job.status == "done":
+            data_map = job.result
+            st.session_state.processed_data = data_map
+            st.session_state.last_result = data_map
+            st.session_state.stage_timings = job.recorder.to_dict()
+            st.success(f"分析完成！共找到 {len(data_map)} 组数据，共计 {int(data_map.segments.sum())} 条计费短信。")
+            if data_map.changed is not None:
+                st.caption(f"增量更新：仅重新计算新增短链，{len(data_map.changed)} 组有变化，其余分组沿用上次结果。")
+        elif job.status == "cancelled":
+            st.warning("分析已取消。")
+        elif getattr(job.error, "duplicates", None) is not None:
+            st.error(f"分析已终止: {job.error}")
+            st.dataframe(job.error.duplicates, use_container_width=True)
+        else:
+            st.error(f"分析失败: {job.error}")
+            st.exception(job.error)
+
+# Links of this analysis that earlier campaigns already sent
+duplicates = getattr(st.session_state.processed_data, "duplicates", None)
+if duplicates is not None and len(duplicates):
+    st.warning(f"⚠️ {len(duplicates)} 条短链已在以往活动中导出过，请确认后再发送。")
+    with st.expander("重复短链 (Reused Links)"):
+        st.dataframe(duplicates, use_container_width=True)
+
+# Stage timings of the last analysis
+if st.session_state.get('stage_timings'):
+    timings = st.session_state.stage_timings
+    with st.expander(f"⏱️ 分析耗时 (Timings): {timings['total_seconds']:.2f} 秒"):
+        st.dataframe(timings['stages'], use_container_width=True)
 
 # Rename & Download (Step 2)
 if st.session_state.processed_data:
@@ -74,59 +250,146 @@ if st.session_state.processed_data:
     st.header("3. 导出设置 (Export Configuration)")
     st.info("检测到以下分组，请依照顺序确认文件名。浏览器会自动下载到您的默认下载文件夹 (通常是 Downloads)。")
     
+    # xlsx by default; CSV (UTF-8) goes straight into the SMS gateway
+    exporter = core()[1]
+    export_fmt = st.selectbox("导出格式 (Export Format)", exporter.EXPORT_FORMATS, index=0)
+    
+    # Oversized groups are split into numbered part files (xlsx always at the sheet limit)
+    col_s1, col_s2 = st.columns(2)
+    with col_s1:
+        max_rows = st.number_input(
+            "每个文件最大行数 (Max Rows, 0 = 不限制)", min_value=0, value=0, step=10000,
+            help=f"xlsx 单个工作表最多 {exporter.EXCEL_MAX_ROWS:,} 行数据，超过时总会自动拆分",
+        )
+    with col_s2:
+        max_mb = st.number_input("每个文件最大大小 (Max MB, 0 = 不限制)", min_value=0.0, value=0.0, step=1.0)
+    max_rows = int(max_rows) or None
+    max_bytes = int(max_mb * 1024 * 1024) or None
+    
     # Form to collect filenames
     with st.form("filename_form"):
+        # Confirmed links are recorded in the link registry under this name
+        campaign = st.text_input("活动名称 (Campaign)", value=st.session_state.get("source_name", ""))
         renamed_files = {}
         sorted_gids = sorted(st.session_state.processed_data.keys())
         
+        processed = st.session_state.processed_data
         for gid in sorted_gids:
-            group_info = st.session_state.processed_data[gid]
-            default_name = group_info['default_name']
+            # processed[gid] would build the whole group, only the name is needed here
+            default_name = processed.default_name(gid)
+            label = processed.group_label(gid)
             
             col1, col2 = st.columns([1, 4])
             with col1:
-                st.markdown(f"**文案组 {gid}**")
-                st.caption(f"({len(group_info['data'])} 行)")
+                st.markdown(f"**文案组 {label}**")
+                st.caption(f"({processed.row_count(gid)} 行, {processed.segment_total(gid)} 条短信)")
             with col2:
                 new_name = st.text_input(
-                    f"文件名 (文案组 {gid})", 
+                    f"文件名 (文案组 {label})", 
                     value=default_name,
                     key=f"name_{gid}",
                     help="请输入您希望保存的文件名，如 result_v1.xlsx"
                 )
                 if not new_name.endswith(".xlsx"):
                     new_name += ".xlsx"
+                # Only the previewed rows are built here, the rest on export
+                with st.expander("预览 (Preview)"):
+                    st.dataframe(processed.preview(gid), use_container_width=True)
                 renamed_files[gid] = new_name
         
         submitted = st.form_submit_button("确认并生成下载链接 (Confirm)")
         if submitted:
             st.session_state.confirmed_filenames = renamed_files
+            st.session_state.bundle_zip = None
+            registry = get_link_registry()
+            if registry is not None:
+                # Reports links another session exported since the analysis
+                late = registry.record(campaign or "未命名活动", processed.link_groups())
+                if len(late):
+                    st.warning(f"⚠️ {len(late)} 条短链已被其他活动导出 (已记录: {campaign})")
 
     # Download Buttons (Step 3) - Outside form for persistence
     if st.session_state.get('confirmed_filenames'):
         st.markdown("### ⬇️ 点击下载 (Click to Download)")
-        st.success("文件名已确认！您可以直接点击下方按钮依次下载。")
-        
-        # Display in a grid
-        cols = st.columns(3) # 3 buttons per row
+        download_mode = st.radio(
+            "下载方式 (Download Mode)",
+            ["逐个下载 (Per Group)", "打包下载全部 (ZIP)"],
+            horizontal=True,
+        )
         
-        for idx, gid in enumerate(sorted_gids):
-            fname = st.session_state.confirmed_filenames[gid]
-            df = st.session_state.processed_data[gid]['data']
-            
-            # Convert to bytes
-            output = io.BytesIO()
-            df.to_excel(output, index=False)
-            output.seek(0)
-            
-            with cols[idx % 3]:
+        if download_mode.startswith("打包"):
+            # Groups are encoded one at a time straight into the ZIP,
+            # only the finished archive is kept in the session
+            confirmed = st.session_state.confirmed_filenames
+            bundle_key = (export_fmt, max_rows, max_bytes)
+            if st.button("📦 生成 ZIP (Build ZIP)"):
+                with st.spinner("正在打包..."):
+                    bundle = io.BytesIO()
+                    named_frames = ((exporter.with_extension(confirmed[gid], export_fmt), processed.group_frame(gid))
+                                    for gid in sorted_gids)
+                    if max_bytes:
+                        # Byte limits need the encoded sizes, parts are encoded first
+                        parts = exporter.encode_parts(
+                            named_frames, max_rows, max_bytes, fmt=export_fmt,
+                            total_rows=sum(processed.row_count(gid) for gid in sorted_gids),
+                        )
+                    else:
+                        parts = exporter.iter_parts(named_frames, max_rows, fmt=export_fmt)
+                    st.session_state.bundle_names = exporter.write_zip_bundle(parts, bundle, fmt=export_fmt)
+                    st.session_state.bundle_zip = bundle.getvalue()
+                    st.session_state.bundle_key = bundle_key
+            if st.session_state.get('bundle_zip') and st.session_state.get('bundle_key') == bundle_key:
                 st.download_button(
-                    label=f"📥 {fname}",
-                    data=output,
-                    file_name=fname,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                    help=f"下载文案组 {gid} 的结果",
-                    use_container_width=True
+                    label=f"📥 下载全部 {len(st.session_state.bundle_names)} 个文件 (ZIP)",
+                    data=st.session_state.bundle_zip,
+                    file_name="output_groups.zip",
+                    mime="application/zip",
                 )
+        else:
+            st.success("文件名已确认！您可以直接点击下方按钮依次下载。")
+            
+            # Display in a grid
+            cols = st.columns(3) # 3 buttons per row
+            
+            # Convert to bytes, cached per group by content key so reruns and
+            # renames neither rebuild nor re-encode a group
+            cache = get_export_cache()
+            keys = {gid: f"{export_fmt}:{max_rows}:{max_bytes}:{processed.group_digest(gid)}"
+                    for gid in sorted_gids}
+            group_parts = {gid: cache.get(keys[gid]) for gid in sorted_gids}
+            missing = [gid for gid in sorted_gids if group_parts[gid] is None]
+            # Groups not in the cache yet are encoded in parallel
+            encoded = exporter.encode_group_parts(
+                (processed.group_frame(gid) for gid in missing),
+                max_rows,
+                max_bytes,
+                fmt=export_fmt,
+                total_rows=sum(processed.row_count(gid) for gid in missing),
+            )
+            for gid, parts in zip(missing, encoded):
+                group_parts[gid] = tuple(parts)
+                cache.put(keys[gid], group_parts[gid])
+            
+            downloads = []
+            for gid in sorted_gids:
+                fname = exporter.with_extension(st.session_state.confirmed_filenames[gid], export_fmt)
+                parts = group_parts[gid]
+                downloads += [(exporter.part_name(fname, k, len(parts)), data)
+                              for k, data in enumerate(parts, start=1)]
+            
+            for idx, (fname, output) in enumerate(downloads):
+                with cols[idx % 3]:
+                    st.download_button(
+                        label=f"📥 {fname}",
+                        data=output,
+                        # Browsers don't keep folders, fan-out files become "<template>_<file>"
+                        file_name=fname.replace("/", "_"),
+                        mime=exporter.MIME_TYPES[export_fmt],
+                        help=f"下载 {fname}",
+                        use_container_width=True
+                    )
             
     st.caption("提示：由于网页安全限制，文件会默认保存到浏览器的下载目录中，无法直接指定保存到 D 盘某文件夹，需您手动移动。")
+
+# Warm the processors and the bundled template plan once the page is out
+prewarm_bundled_plan()
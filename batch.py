@@ -0,0 +1,240 @@
+"""
+Headless batch runner for the cloud processor.
+
+Usage:
+    python batch.py jobs.json --output out/ --workers 8 --summary summary.json
+    python batch.py campaigns_dir/ --output out/
+    python batch.py jobs.json --registry links.sqlite3 --on-duplicate reject
+
+The summary JSON holds per-job group row counts, timings and per-stage
+instrumentation (see core_logic/instrument.py); --trace-memory adds each
+stage's Python allocation peak, at some cost in speed.
+
+A manifest is a JSON list of jobs:
+    [{"name": "海灯节_US", "source": "links.xlsx", "template": "tpl.xlsx",
+      "filename": "{name}_group_{gid}.xlsx"}]
+("name" and "filename" are optional.)
+
+A directory holds one sub-directory per campaign, each with one template
+(file name contains "模板" or "template") and its short-link exports
+(xlsx, xls, csv, parquet or a ZIP of them). Several exports of one
+campaign are read in parallel and concatenated in file name order; in a
+manifest "source" may be a list of files for the same.
+
+With --registry every exported link is recorded under its job name, and
+links already exported by an earlier campaign are counted in the summary
+(or fail the job with --on-duplicate reject), see core_logic/link_registry.py.
+
+Output files are written in the format of their extension; --format sets
+the extension of the default file name pattern (xlsx unless given).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'core_logic'))
+try:
+    from processor_cloud import build_groups
+    from exporter import export_parts, export_format, EXPORT_FORMATS
+    from instrument import StageRecorder
+    from link_registry import LinkRegistry, DUPLICATE_POLICIES
+except ImportError:
+    from core_logic.processor_cloud import build_groups
+    from core_logic.exporter import export_parts, export_format, EXPORT_FORMATS
+    from core_logic.instrument import StageRecorder
+    from core_logic.link_registry import LinkRegistry, DUPLICATE_POLICIES
+
+DEFAULT_FILENAME = "output_group_{gid}.{ext}"
+
+# Jobs already run side by side on the batch pool, so a job reads its
+# sources and encodes its groups with one worker instead of a pool of its own
+JOB_WORKERS = 1
+
+EXCEL_EXTENSIONS = (".xlsx", ".xls")
+SOURCE_EXTENSIONS = EXCEL_EXTENSIONS + (".csv", ".parquet", ".zip")
+
+
+def _is_template(fname):
+    lower = fname.lower()
+    return "模板" in fname or "template" in lower
+
+
+def load_jobs(path):
+    """Read jobs from a JSON manifest or a directory of campaign folders."""
+    if os.path.isdir(path):
+        return _jobs_from_dir(path)
+
+    with open(path, "r", encoding="utf-8") as f:
+        jobs = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    for idx, job in enumerate(jobs):
+        first = job["source"][0] if isinstance(job["source"], list) else job["source"]
+        job.setdefault("name", os.path.splitext(os.path.basename(first))[0] or f"job_{idx + 1}")
+        # Relative paths are relative to the manifest
+        if isinstance(job["source"], list):
+            job["source"] = [os.path.join(base, source) for source in job["source"]]
+        else:
+            job["source"] = os.path.join(base, job["source"])
+        job["template"] = os.path.join(base, job["template"])
+    return jobs
+
+
+def _jobs_from_dir(path):
+    jobs = []
+    for name in sorted(os.listdir(path)):
+        folder = os.path.join(path, name)
+        if not os.path.isdir(folder):
+            continue
+        files = sorted(f for f in os.listdir(folder)
+                       if f.lower().endswith(SOURCE_EXTENSIONS) and not f.startswith("~$"))
+        templates = [f for f in files if _is_template(f) and f.lower().endswith(EXCEL_EXTENSIONS)]
+        sources = [f for f in files if not _is_template(f)]
+        if len(templates) != 1 or not sources:
+            print(f"跳过 {folder}: 需要恰好一个模板文件和至少一个短链文件", file=sys.stderr)
+            continue
+        paths = [os.path.join(folder, source) for source in sources]
+        jobs.append({
+            "name": name,
+            "source": paths[0] if len(paths) == 1 else paths,
+            "template": os.path.join(folder, templates[0]),
+        })
+    return jobs
+
+
+def run_job(job, output_root, fmt="xlsx", max_rows=None, max_bytes=None, registry=None, on_duplicate="flag",
+            trace_memory=False):
+    """
+    Run one campaign and return its summary record.
+    Groups over `max_rows`/`max_bytes` are written as numbered part files.
+    With a LinkRegistry as `registry` the written links are recorded under
+    the job name. `trace_memory` records per-stage allocation peaks.
+    """
+    started = time.perf_counter()
+    record = {"name": job["name"], "source": job["source"], "template": job["template"]}
+    recorder = StageRecorder(trace_memory=trace_memory)
+    try:
+        out_dir = os.path.join(output_root, job["name"])
+        os.makedirs(out_dir, exist_ok=True)
+
+        # The processors print debug lines, keep the batch log readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = build_groups(job["source"], job["template"], recorder,
+                                  registry=registry, on_duplicate=on_duplicate, workers=JOB_WORKERS)
+            gids = list(result.ranges)
+            pattern = job.get("filename", DEFAULT_FILENAME)
+            fnames = [pattern.format(name=job["name"], gid=gid, ext=fmt) for gid in gids]
+            rows = [result.row_count(gid) for gid in gids]
+            # Each group frame is built right before it is written
+            files = []
+            with recorder.stage("encode", rows=sum(rows)):
+                for gid, fname in zip(gids, fnames):
+                    written = export_parts([(fname, result.group_frame(gid))], out_dir, max_rows, max_bytes,
+                                           workers=JOB_WORKERS, fmt=export_format(fname))
+                    files.append([path for _, path in written])
+
+            duplicates = set()
+            if registry is not None:
+                # Also catches links another job of this batch recorded meanwhile
+                with recorder.stage("record_links", rows=len(result.links)):
+                    late = registry.record(job["name"], result.link_groups())
+                duplicates = set(result.duplicates["link"]) | set(late["link"])
+
+        record.update({
+            "status": "ok",
+            "groups": [{"group": str(gid), "rows": count, "segments": result.segment_total(gid),
+                        "file": paths[0], "files": paths}
+                       for gid, count, paths in zip(gids, rows, files)],
+            "rows": sum(rows),
+            "segments": int(result.segments.sum()),
+            "duplicates": len(duplicates),
+        })
+    except Exception as e:
+        record.update({"status": "error", "error": f"{type(e).__name__}: {e}"})
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    record["stages"] = recorder.records
+    return record
+
+
+def run_batch(jobs, output_root, workers=None, log=sys.stdout, fmt="xlsx", max_rows=None, max_bytes=None,
+              registry=None, on_duplicate="flag", trace_memory=False):
+    """Run all jobs on a process pool, streaming one progress line per job."""
+    workers = workers or os.cpu_count() or 1
+    records = []
+    total = len(jobs)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_job, job, output_root, fmt, max_rows, max_bytes, registry, on_duplicate,
+                               trace_memory): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            record = future.result()
+            records.append(record)
+            if record["status"] == "ok":
+                detail = f"{len(record['groups'])} groups, {record['rows']} rows, {record['segments']} segments"
+                if record["duplicates"]:
+                    detail += f", {record['duplicates']} reused links"
+            else:
+                detail = record["error"]
+            print(f"[{done}/{total}] {record['name']}: {record['status']} ({detail}) {record['seconds']}s",
+                  file=log, flush=True)
+
+    # Keep the summary in manifest order regardless of completion order
+    order = {job["name"]: idx for idx, job in enumerate(jobs)}
+    records.sort(key=lambda r: order.get(r["name"], 0))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批量生成短信文案分组文件 (无需浏览器)")
+    parser.add_argument("jobs", help="JSON manifest, or a directory with one folder per campaign")
+    parser.add_argument("-o", "--output", default="output_batch", help="output root directory")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="parallel jobs (default: CPU count)")
+    parser.add_argument("--summary", default=None, help="summary JSON path (default: <output>/summary.json)")
+    parser.add_argument("-f", "--format", choices=EXPORT_FORMATS, default="xlsx",
+                        help="format of the default output file names (default: xlsx)")
+    parser.add_argument("--max-rows", type=int, default=None,
+                        help="split groups into part files of at most this many rows (xlsx: always at the sheet limit)")
+    parser.add_argument("--max-mb", type=float, default=None, help="split groups into part files of at most this size")
+    parser.add_argument("--registry", default=None, help="link registry (SQLite) to check and record exported links in")
+    parser.add_argument("--on-duplicate", choices=DUPLICATE_POLICIES, default="flag",
+                        help="flag (count in the summary) or reject jobs with links already in the registry")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the Python allocation peak of every stage (slower)")
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.jobs)
+    if not jobs:
+        print("没有找到可处理的任务", file=sys.stderr)
+        return 1
+
+    names = [job["name"] for job in jobs]
+    if len(set(names)) != len(names):
+        print("任务名称重复，请在 manifest 中指定唯一的 name", file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    max_bytes = int(args.max_mb * 1024 * 1024) if args.max_mb else None
+    registry = LinkRegistry(args.registry) if args.registry else None
+    records = run_batch(jobs, args.output, args.workers, fmt=args.format, max_rows=args.max_rows, max_bytes=max_bytes,
+                        registry=registry, on_duplicate=args.on_duplicate, trace_memory=args.trace_memory)
+
+    summary = {
+        "jobs": records,
+        "ok": sum(1 for r in records if r["status"] == "ok"),
+        "failed": sum(1 for r in records if r["status"] != "ok"),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    summary_path = args.summary or os.path.join(args.output, "summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"完成: {summary['ok']} 成功, {summary['failed']} 失败, 汇总 -> {summary_path}")
+    return 0 if summary["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
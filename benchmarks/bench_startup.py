@@ -0,0 +1,113 @@
+"""
+Benchmark the app's cold start.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --json startup.json
+
+Every measurement runs in a fresh interpreter:
+  - import:<name>  wall time of importing a module set (python -c "import ...")
+  - first_render   wall time of the first full script run of app.py
+                   (streamlit AppTest), i.e. what a new container pays before
+                   the page is shown
+
+Run it on two commits and compare the JSON files (the commit is recorded).
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> modules imported together (core_logic is on sys.path)
+IMPORT_SETS = {
+    "streamlit": ["streamlit"],
+    "app_eager": ["streamlit", "jobs", "uploads"],  # what app.py imports at startup
+    "pipeline": ["processor_cloud", "exporter"],  # deferred to the first analysis
+}
+
+_IMPORT_SNIPPET = """
+import sys, time
+sys.path.insert(0, {core!r})
+started = time.perf_counter()
+{imports}
+print(time.perf_counter() - started)
+"""
+
+_RENDER_SNIPPET = """
+import time, warnings
+warnings.filterwarnings("ignore")
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app!r}, default_timeout=120).run()
+elapsed = time.perf_counter() - started
+assert not at.exception, at.exception
+print(elapsed)
+"""
+
+
+def _run_snippet(code):
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip()[-500:])
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def measure_import(modules):
+    imports = "\n".join(f"import {name}" for name in modules)
+    return _run_snippet(_IMPORT_SNIPPET.format(core=os.path.join(ROOT, "core_logic"), imports=imports))
+
+
+def measure_first_render():
+    return _run_snippet(_RENDER_SNIPPET.format(app=os.path.join(ROOT, "app.py")))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app's cold start")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters per measurement")
+    parser.add_argument("--no-render", action="store_true", help="skip the app.py first-render case")
+    parser.add_argument("--json", default=None, help="write results JSON here")
+    args = parser.parse_args(argv)
+
+    cases = [(f"import:{name}", lambda modules=modules: measure_import(modules))
+             for name, modules in IMPORT_SETS.items()]
+    if not args.no_render:
+        cases.append(("first_render", measure_first_render))
+
+    results = []
+    for name, func in cases:
+        try:
+            samples = [func() for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{name:20s} failed: {e}", file=sys.stderr)
+            results.append({"case": name, "error": str(e)})
+            continue
+        record = {"case": name, "median_s": round(statistics.median(samples), 3),
+                  "min_s": round(min(samples), 3), "samples": [round(s, 3) for s in samples]}
+        print(f"{name:20s} {record['median_s']:8.3f}s (min {record['min_s']:.3f}s)")
+        results.append(record)
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+"""
+Synthetic inputs for the benchmarks.
+
+make_source(): a short-link export shaped like the platform's
+short-link-admin_download_task*_result.xlsx (several unused columns + 短链接).
+make_template(): a multi-language template with a configurable number of
+文案 groups, laid out like 自动化工具模板.xlsx.
+
+Files are written with xlsxwriter in constant_memory mode so even 1M rows
+generate quickly, and are reused if they already exist. Their names carry
+GENERATOR_VERSION (see data_name), so files written by an older generator
+are never picked up.
+"""
+import os
+
+import xlsxwriter
+
+LANGUAGES = ["de-de", "en-us", "es-es", "fr-fr", "id-id", "ja-jp", "ko-kr",
+             "pt-pt", "ru-ru", "th-th", "vi-vn", "zh-cn", "zh-tw"]
+
+# Bump whenever the generated content changes
+GENERATOR_VERSION = 2
+
+REGIONS = ["DE", "US", "ES", "FR", "ID", "JP", "KR", "PT", "RU", "TH", "VN", "CN", "TW"]
+
+TEMPLATE_HEADER = ["文案", "正文", "回到提瓦特", "链接", "退订",
+                   "语言标识", "区域列表（使用半角逗号分隔）", "发信人/签名", "标题", "内容"]
+
+
+def data_name(stem, ext="xlsx"):
+    """File name of a generated input, tagged with GENERATOR_VERSION."""
+    return f"{stem}_v{GENERATOR_VERSION}.{ext}"
+
+
+def _write(path, header, rows):
+    # strings_to_urls off: xlsxwriter keeps only 65,530 URLs per sheet and drops the rest
+    wb = xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_urls": False})
+    ws = wb.add_worksheet("Sheet1")
+    ws.write_row(0, 0, header)
+    for r, row in enumerate(rows, start=1):
+        for c, value in enumerate(row):
+            if value is not None:
+                ws.write(r, c, value)
+    wb.close()
+
+
+def make_source(path, rows):
+    """Short-link export with `rows` links."""
+    if os.path.exists(path):
+        return path
+    header = ["任务ID", "原始链接", "渠道", "短链接", "创建时间", "备注"]
+    _write(path, header, (
+        (i, f"https://act.example.com/lanternrite?utm_source=sms&uid={i}", "sms",
+         f"https://hoyo.link/{i:08x}", "2026-01-30 10:00:00", "")
+        for i in range(rows)
+    ))
+    return path
+
+
+def make_template(path, rows, groups=10, languages=None):
+    """
+    Template with `rows` rows spread over `groups` 文案 groups.
+    Every 20th row has an incomplete 语言/区域 pair and is filtered out.
+    """
+    if os.path.exists(path):
+        return path
+    languages = languages or LANGUAGES
+
+    def row(i):
+        gid = i % groups + 1
+        lang_idx = i % len(languages)
+        incomplete = i % 20 == 19
+        return (
+            gid,
+            f"Genshin Impact: Lantern Rite copy #{gid}, log in to claim Primogems ×1,600!",
+            "Return to Teyvat >> ",
+            None,
+            "SMS replies not supported. To unsubscribe, visit account.hoyoverse.com. ",
+            None if incomplete else f"{languages[lang_idx]}_{REGIONS[lang_idx % len(REGIONS)].lower()}",
+            None if incomplete else REGIONS[lang_idx % len(REGIONS)],
+            "HoYoverse",
+            None,
+            None,
+        )
+
+    _write(path, TEMPLATE_HEADER, (row(i) for i in range(rows)))
+    return path
@@ -0,0 +1,142 @@
+"""
+Benchmark the processing pipelines on synthetic data.
+
+    python benchmarks/run_benchmarks.py                      # 1k + 100k
+    python benchmarks/run_benchmarks.py --sizes 1000 100000 1000000 --groups 50
+    python benchmarks/run_benchmarks.py --modes cloud export --json bench.json
+
+Every (mode, size) case runs in a fresh subprocess so wall time and peak
+RSS are not polluted by earlier cases. Results are written as JSON together
+with the git commit, so runs can be compared across commits.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "core_logic"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ["cloud", "pure-python", "export"]
+
+# Pure-python mode fans every link out over this many template rows
+PURE_PYTHON_TEMPLATE_ROWS = 40
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _inputs(data_dir, size, groups):
+    from generate import data_name, make_source, make_template
+
+    os.makedirs(data_dir, exist_ok=True)
+    source = make_source(os.path.join(data_dir, data_name(f"source_{size}")), size)
+    template = make_template(os.path.join(data_dir, data_name(f"template_{size}_{groups}g")), size, groups)
+    return source, template
+
+
+def run_case(mode, size, groups, data_dir, workers):
+    """Run a single case in this process and return its result record."""
+    import contextlib
+    import io
+
+    source, template = _inputs(data_dir, size, groups)
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode == "cloud":
+            from processor_cloud import build_groups
+            result = build_groups(source, template).frames()
+            rows = sum(len(df) for _, df in result)
+        elif mode == "export":
+            from processor_cloud import build_groups
+            from exporter import encode_groups
+            result = build_groups(source, template).frames()
+            encoded = encode_groups([df for _, df in result], workers)
+            rows = sum(len(df) for _, df in result)
+            bytes_out = sum(len(data) for data in encoded)
+        elif mode == "pure-python":
+            import pandas as pd
+            from processor_python import expand_links
+            from source_reader import read_links
+            template_df = pd.read_excel(template, nrows=PURE_PYTHON_TEMPLATE_ROWS)
+            links, _ = read_links(source)
+            links = links[:max(1, size // PURE_PYTHON_TEMPLATE_ROWS)]
+            rows = len(expand_links(template_df, links))
+        else:
+            raise ValueError(f"unknown mode {mode}")
+    wall = time.perf_counter() - started
+
+    record = {"mode": mode, "size": size, "groups": groups, "rows_out": rows,
+              "wall_s": round(wall, 3), "peak_rss_mb": _peak_rss_mb()}
+    if mode == "export":
+        record["bytes_out"] = bytes_out
+    return record
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SMS pipelines")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--groups", type=int, default=10, help="文案 groups in the template")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--workers", type=int, default=None, help="export workers")
+    parser.add_argument("--data-dir", default=os.path.join(ROOT, "benchmarks", ".data"))
+    parser.add_argument("--json", default=None, help="write results JSON here")
+    parser.add_argument("--single", nargs=2, metavar=("MODE", "SIZE"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.single:
+        mode, size = args.single
+        print(json.dumps(run_case(mode, int(size), args.groups, args.data_dir, args.workers)))
+        return 0
+
+    # Generate inputs up front so generation time is not measured
+    for size in args.sizes:
+        _inputs(args.data_dir, size, args.groups)
+
+    results = []
+    for size in args.sizes:
+        for mode in args.modes:
+            cmd = [sys.executable, os.path.abspath(__file__), "--single", mode, str(size),
+                   "--groups", str(args.groups), "--data-dir", args.data_dir]
+            if args.workers:
+                cmd += ["--workers", str(args.workers)]
+            out = subprocess.run(cmd, capture_output=True, text=True)
+            if out.returncode != 0:
+                print(out.stderr, file=sys.stderr)
+                record = {"mode": mode, "size": size, "groups": args.groups, "error": out.stderr.strip()[-500:]}
+            else:
+                record = json.loads(out.stdout.strip().splitlines()[-1])
+                print(f"{mode:12s} {size:>9d} rows  {record['wall_s']:8.3f}s  {record['peak_rss_mb']:8.1f} MB")
+            results.append(record)
+
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
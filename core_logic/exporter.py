@@ -0,0 +1,525 @@
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import pandas as pd
+import xlsxwriter
+
+
+# Groups with at least this many rows are written in constant-memory mode
+STREAMING_MIN_ROWS = 50000
+
+# Rows converted to Python objects at a time while streaming
+STREAM_BLOCK_ROWS = 10000
+
+# Same header style pandas uses for to_excel with xlsxwriter
+HEADER_FORMAT = {"bold": True, "border": 1, "align": "center", "valign": "top"}
+
+# Export formats, xlsx stays the default everywhere
+EXPORT_FORMATS = ("xlsx", "csv", "parquet")
+
+# The SMS gateway ingests plain UTF-8 CSV (no BOM)
+CSV_ENCODING = "utf-8"
+
+MIME_TYPES = {
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def export_format(path=None, fmt=None):
+    """Resolve the export format: explicit `fmt`, else the file extension, else xlsx."""
+    if fmt is None:
+        ext = os.path.splitext(os.fspath(path))[1].lower().lstrip(".") if path else ""
+        fmt = ext if ext in EXPORT_FORMATS else "xlsx"
+    fmt = fmt.lower().lstrip(".")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}（支持 {', '.join(EXPORT_FORMATS)}）")
+    return fmt
+
+
+def with_extension(fname, fmt):
+    """Swap the file name's extension for the export format's."""
+    stem, ext = os.path.splitext(fname)
+    if ext.lower().lstrip(".") in EXPORT_FORMATS:
+        fname = stem
+    return f"{fname}.{fmt}"
+
+
+def _write_csv_blocks(df, text):
+    # Header once, then STREAM_BLOCK_ROWS rows at a time
+    if len(df) == 0:
+        df.to_csv(text, index=False)
+        return
+    for start in range(0, len(df), STREAM_BLOCK_ROWS):
+        df.iloc[start:start + STREAM_BLOCK_ROWS].to_csv(text, index=False, header=start == 0)
+
+
+def write_csv(df, target):
+    """Stream one group to UTF-8 CSV at `target` (file path or binary file object)."""
+    if isinstance(target, (str, os.PathLike)):
+        with open(target, "w", encoding=CSV_ENCODING, newline="") as f:
+            _write_csv_blocks(df, f)
+        return
+    text = io.TextIOWrapper(target, encoding=CSV_ENCODING, newline="")
+    try:
+        _write_csv_blocks(df, text)
+        text.flush()
+    finally:
+        # Leave the caller's file object open
+        text.detach()
+
+
+def write_group(df, target, streaming=None, fmt="xlsx"):
+    """
+    Write one group to `target` (file path or binary file object) as
+    `fmt` (xlsx, csv or parquet). CSV is always written block by block.
+    For xlsx, streaming=True sends rows straight into the container through
+    xlsxwriter's constant_memory mode instead of building the workbook in
+    memory first. streaming=None picks it for groups of STREAMING_MIN_ROWS+.
+    """
+    if fmt == "csv":
+        write_csv(df, target)
+        return
+    if fmt == "parquet":
+        # Needs pyarrow; repeated text columns stay dictionary-encoded
+        df.to_parquet(target, index=False)
+        return
+    if fmt != "xlsx":
+        raise ValueError(f"不支持的导出格式: {fmt}（支持 {', '.join(EXPORT_FORMATS)}）")
+
+    if streaming is None:
+        streaming = len(df) >= STREAMING_MIN_ROWS
+    if not streaming:
+        df.to_excel(target, index=False)
+        return
+
+    wb = xlsxwriter.Workbook(target, {"constant_memory": True})
+    try:
+        ws = wb.add_worksheet("Sheet1")
+        header_format = wb.add_format(HEADER_FORMAT)
+        for col, name in enumerate(df.columns):
+            ws.write(0, col, str(name), header_format)
+
+        # constant_memory requires row-by-row order
+        row = 1
+        for start in range(0, len(df), STREAM_BLOCK_ROWS):
+            block = df.iloc[start:start + STREAM_BLOCK_ROWS].astype(object)
+            block = block.where(block.notna(), None)
+            for values in block.itertuples(index=False, name=None):
+                for col, value in enumerate(values):
+                    if value is not None:
+                        ws.write(row, col, value)
+                row += 1
+    finally:
+        wb.close()
+
+
+def encode_group(df, fmt="xlsx"):
+    """Serialize one group to bytes (xlsx unless `fmt` says otherwise)."""
+    output = io.BytesIO()
+    write_group(df, output, fmt=fmt)
+    return output.getvalue()
+
+
+def group_encoder(fmt="xlsx"):
+    """Picklable encoder for `fmt`, usable with the process pool."""
+    fmt = export_format(fmt=fmt)
+    return encode_group if fmt == "xlsx" else partial(encode_group, fmt=fmt)
+
+
+def _write_group_job(job):
+    df, path, fmt = job
+    write_group(df, path, fmt=fmt)
+    return path
+
+
+# Below this many rows in total, pool start-up costs more than it saves
+PARALLEL_MIN_ROWS = 20000
+
+# Items submitted ahead of the results per pool worker (see _imap_parallel)
+PENDING_PER_WORKER = 2
+
+
+def default_workers():
+    """Worker count for parallel export, overridable with SMS_EXPORT_WORKERS."""
+    env = os.environ.get("SMS_EXPORT_WORKERS")
+    if env:
+        return max(1, int(env))
+    return os.cpu_count() or 1
+
+
+def _imap_parallel(func, items, total_rows=None, workers=None):
+    """
+    Lazily map `func` over the iterable `items` on one process pool,
+    yielding results in input order. Only PENDING_PER_WORKER items per
+    worker are taken ahead of the results, so a lazy `items` is never
+    built up front. Runs serially for a single worker or below
+    PARALLEL_MIN_ROWS `total_rows` (None: unknown).
+    """
+    if workers is None:
+        workers = default_workers()
+    if workers <= 1 or total_rows is not None and total_rows < PARALLEL_MIN_ROWS:
+        for item in items:
+            yield func(item)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(func, item))
+            if len(pending) >= workers * PENDING_PER_WORKER:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _run_parallel(func, items, total_rows, workers=None):
+    """Map `func` over `items` on a process pool, keeping the input order."""
+    if workers is None:
+        workers = default_workers()
+    return list(_imap_parallel(func, items, total_rows, min(workers, len(items))))
+
+
+def encode_groups(frames, workers=None, encoder=None, fmt="xlsx"):
+    """
+    Encode many group frames, in parallel across a process pool when worth it.
+    Results come back in the same order as `frames`.
+    Falls back to serial encoding for a single worker, a single group or
+    a job smaller than PARALLEL_MIN_ROWS.
+    """
+    if encoder is None:
+        encoder = group_encoder(fmt)
+    frames = list(frames)
+    return _run_parallel(encoder, frames, sum(len(df) for df in frames), workers)
+
+
+def export_groups(frames, paths, workers=None, fmt=None):
+    """
+    Write many group frames straight to their file paths, in parallel.
+    Each file's format comes from its extension unless `fmt` is given.
+    Large groups stream to disk, so neither side holds the whole workbook.
+    Returns the paths in input order.
+    """
+    frames = list(frames)
+    jobs = [(df, path, export_format(path, fmt)) for df, path in zip(frames, paths)]
+    return _run_parallel(_write_group_job, jobs, sum(len(df) for df in frames), workers)
+
+
+# One xlsx sheet holds 1,048,576 rows, one of them the header
+EXCEL_MAX_ROWS = 1048575
+
+# Byte-limited parts aim this far below the limit; a part that still ends
+# up too large is split in half and encoded again
+PART_BYTES_MARGIN = 0.9
+
+# Rows encoded to estimate the encoded size of one row
+SIZE_SAMPLE_ROWS = 2000
+
+# Estimated bytes per row by (format, sample digest), so re-splitting the
+# same group (app reruns, ZIP after per-file downloads) doesn't re-encode
+# its sample
+ROW_BYTES_CACHE_SIZE = 4096
+_row_bytes = OrderedDict()
+_row_bytes_lock = threading.Lock()
+
+
+def part_name(fname, part, total):
+    """File name of part `part` (1-based) of `total`; unchanged for a single part."""
+    if total <= 1:
+        return fname
+    stem, ext = os.path.splitext(fname)
+    return f"{stem}_part{part}{ext}"
+
+
+def _bytes_per_row(sample, fmt, encoder=None):
+    # `encoder` must write `fmt`, the estimate is cached by format
+    key = (fmt, frame_digest(sample))
+    with _row_bytes_lock:
+        per_row = _row_bytes.get(key)
+        if per_row is not None:
+            _row_bytes.move_to_end(key)
+            return per_row
+    # Includes the container overhead, so small samples overestimate
+    per_row = len((encoder or group_encoder(fmt))(sample)) / len(sample)
+    with _row_bytes_lock:
+        _row_bytes[key] = per_row
+        if len(_row_bytes) > ROW_BYTES_CACHE_SIZE:
+            _row_bytes.popitem(last=False)
+    return per_row
+
+
+def split_group(df, max_rows=None, max_bytes=None, fmt="xlsx", encoder=None):
+    """
+    Row ranges [(start, stop), ...] splitting one group into parts of at
+    most `max_rows` rows (xlsx is always capped at EXCEL_MAX_ROWS) and, by
+    an estimate from the first SIZE_SAMPLE_ROWS rows, `max_bytes` bytes.
+    The estimate is memoised by the sample's content (see _bytes_per_row).
+    """
+    limits = [max_rows] if max_rows else []
+    if fmt == "xlsx":
+        limits.append(EXCEL_MAX_ROWS)
+    if max_bytes and len(df):
+        per_row = _bytes_per_row(df.iloc[:SIZE_SAMPLE_ROWS], fmt, encoder)
+        limits.append(max(1, int(max_bytes * PART_BYTES_MARGIN / per_row)))
+    step = min(limits) if limits else len(df)
+    if len(df) <= step:
+        return [(0, len(df))]
+    return [(start, min(start + step, len(df))) for start in range(0, len(df), step)]
+
+
+def iter_parts(named_frames, max_rows=None, max_bytes=None, fmt="xlsx"):
+    """
+    Lazily yield (file name, frame) for every part of every group,
+    parts being row slices (see split_group and part_name).
+    """
+    for fname, df in named_frames:
+        ranges = split_group(df, max_rows, max_bytes, fmt)
+        for k, (start, stop) in enumerate(ranges, start=1):
+            yield part_name(fname, k, len(ranges)), df.iloc[start:stop]
+
+
+def encode_group_parts(frames, max_rows=None, max_bytes=None, workers=None, fmt="xlsx",
+                       total_rows=None):
+    """
+    Split every frame of the iterable `frames` into parts (see split_group)
+    and encode them. The parts of all groups share one process pool with a
+    bounded number in flight (see _imap_parallel), so small groups are
+    encoded side by side, one huge group's parts too, and `frames` is
+    consumed lazily.
+    Parts over `max_bytes` are halved and encoded again, one group at a
+    time, until they fit (or are a single row).
+    Yields the list of part bytes of each frame, in order.
+    """
+    encoder = group_encoder(fmt)
+    if total_rows is None and isinstance(frames, (list, tuple)):
+        total_rows = sum(len(df) for df in frames)
+
+    # (group, start, stop) of every part in submission order
+    taken = deque()
+    # group -> [frame (kept for re-splitting), part count, [(start, stop, bytes)]]
+    groups = {}
+
+    def jobs():
+        for g, df in enumerate(frames):
+            ranges = split_group(df, max_rows, max_bytes, fmt, encoder)
+            groups[g] = [df if max_bytes else None, len(ranges), []]
+            for start, stop in ranges:
+                taken.append((g, start, stop))
+                yield df.iloc[start:stop]
+
+    for data in _imap_parallel(encoder, jobs(), total_rows, workers):
+        g, start, stop = taken.popleft()
+        df, count, parts = groups[g]
+        parts.append((start, stop, data))
+        if len(parts) < count:
+            continue
+        del groups[g]
+
+        pending = [(start, stop) for start, stop, data in parts
+                   if max_bytes and len(data) > max_bytes and stop - start > 1]
+        parts = [part for part in parts if (part[0], part[1]) not in pending]
+        while pending:
+            halves = []
+            for start, stop in pending:
+                middle = (start + stop) // 2
+                halves += [(start, middle), (middle, stop)]
+            encoded = encode_groups([df.iloc[start:stop] for start, stop in halves], workers, encoder)
+            pending = []
+            for (start, stop), data in zip(halves, encoded):
+                if len(data) > max_bytes and stop - start > 1:
+                    pending.append((start, stop))
+                else:
+                    parts.append((start, stop, data))
+
+        parts.sort(key=lambda part: part[0])
+        yield [data for _, _, data in parts]
+
+
+def encode_parts(named_frames, max_rows=None, max_bytes=None, workers=None, fmt="xlsx",
+                 total_rows=None):
+    """
+    Split every group into parts and encode them (see encode_group_parts).
+    `named_frames` is consumed lazily; pass `total_rows` when it is a
+    generator so small jobs stay serial.
+    Yields (file name, bytes) in group and part order.
+    """
+    if total_rows is None and isinstance(named_frames, (list, tuple)):
+        total_rows = sum(len(df) for _, df in named_frames)
+    names = deque()
+
+    def frames():
+        for fname, df in named_frames:
+            names.append(fname)
+            yield df
+
+    for parts in encode_group_parts(frames(), max_rows, max_bytes, workers, fmt, total_rows):
+        fname = names.popleft()
+        for k, data in enumerate(parts, start=1):
+            yield part_name(fname, k, len(parts)), data
+
+
+def export_parts(named_frames, output_dir, max_rows=None, max_bytes=None, workers=None, fmt="xlsx",
+                 total_rows=None):
+    """
+    Write every part of every group into `output_dir` ("<dir>/<file>"
+    names go to sub-directories).
+    Row limits only: parts stream straight to disk in parallel, groups
+    being taken from `named_frames` as pool workers free up.
+    With `max_bytes` the parts are encoded first so oversized ones can be
+    split again (encode_parts), each written as soon as it comes back.
+    Returns [(file name, path), ...].
+    """
+    if not max_bytes:
+        if total_rows is None and isinstance(named_frames, (list, tuple)):
+            total_rows = sum(len(df) for _, df in named_frames)
+        written = []
+
+        def jobs():
+            # Groups are taken lazily, only the parts in flight are held
+            for fname, df in iter_parts(named_frames, max_rows, None, fmt):
+                path = os.path.join(output_dir, fname)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                written.append((fname, path))
+                yield df, path, export_format(path, fmt)
+
+        for _ in _imap_parallel(_write_group_job, jobs(), total_rows, workers):
+            pass
+        return written
+
+    written = []
+    for fname, data in encode_parts(named_frames, max_rows, max_bytes, workers, fmt, total_rows):
+        path = os.path.join(output_dir, fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        written.append((fname, path))
+    return written
+
+
+def _unique_name(name, used):
+    if name not in used:
+        return name
+    stem, ext = os.path.splitext(name)
+    n = 2
+    while f"{stem} ({n}){ext}" in used:
+        n += 1
+    return f"{stem} ({n}){ext}"
+
+
+def write_zip_bundle(named_frames, target, encoder=None, compression=zipfile.ZIP_DEFLATED, fmt="xlsx"):
+    """
+    Write every group file into one ZIP archive at `target` (path or
+    binary file object). `named_frames` is an iterable of (filename, frame)
+    and is consumed lazily: each group is encoded, compressed and written
+    before the next one is encoded, so peak memory is a single workbook.
+    Items may also carry already encoded bytes instead of a frame
+    (e.g. the output of encode_parts).
+    Duplicate file names get a " (2)" style suffix.
+    Returns the file names written, in order.
+    """
+    if encoder is None:
+        encoder = group_encoder(fmt)
+    names = []
+    used = set()
+    with zipfile.ZipFile(target, "w", compression=compression) as zf:
+        for fname, df in named_frames:
+            fname = _unique_name(fname, used)
+            used.add(fname)
+            zf.writestr(fname, df if isinstance(df, (bytes, bytearray)) else encoder(df))
+            names.append(fname)
+    return names
+
+
+def frame_digest(df):
+    """
+    Content hash of a group DataFrame (column names + cell values).
+    The index is ignored, so the same rows always hash the same.
+    """
+    h = hashlib.sha256()
+    h.update(repr([str(c) for c in df.columns]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+
+def _nbytes(data):
+    # Cached values are bytes or tuples of part bytes
+    return len(data) if isinstance(data, bytes) else sum(len(part) for part in data)
+
+
+def cache_key(df, fmt="xlsx"):
+    """EncodedCache key of `df` encoded as `fmt`."""
+    return f"{fmt}:{frame_digest(df)}"
+
+
+class EncodedCache:
+    """
+    Size-bounded LRU cache of encoded workbooks, keyed by frame_digest().
+    The file name is not part of the key: it does not change the workbook
+    bytes, so renaming a download never forces a re-encode. The export
+    format is, so xlsx and csv of the same group are cached separately.
+    Callers may also put() their own keys, with bytes or a tuple of part
+    bytes as the value (see GroupedResult.group_digest).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_encode(self, df, encoder=None, fmt="xlsx"):
+        if encoder is None:
+            encoder = group_encoder(fmt)
+        key = cache_key(df, fmt)
+        data = self.get(key)
+        if data is not None:
+            return data
+
+        data = encoder(df)
+        self.put(key, data)
+        return data
+
+    def get_or_encode_many(self, frames, workers=None, encoder=None, fmt="xlsx"):
+        """Like get_or_encode() for a list of frames; misses are encoded in parallel."""
+        if encoder is None:
+            encoder = group_encoder(fmt)
+        frames = list(frames)
+        keys = [cache_key(df, fmt) for df in frames]
+        results = [self.get(key) for key in keys]
+
+        missing = [i for i, data in enumerate(results) if data is None]
+        encoded = encode_groups([frames[i] for i in missing], workers, encoder)
+        for i, data in zip(missing, encoded):
+            self.put(keys[i], data)
+            results[i] = data
+        return results
+
+    def get(self, key):
+        """Cached value of `key`, or None."""
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.total_bytes -= _nbytes(old)
+            self._items[key] = data
+            self.total_bytes += _nbytes(data)
+            # Evict least recently used, but always keep the newest entry
+            while self.total_bytes > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.total_bytes -= _nbytes(evicted)
+
+    def __len__(self):
+        return len(self._items)
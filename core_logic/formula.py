@@ -0,0 +1,528 @@
+"""
+Vectorized evaluator for the template's own 内容 formulas.
+
+The formula text is read from the template with openpyxl and compiled into
+a small expression tree. Each distinct formula (after normalizing cell
+references relative to the row it sits on) is then evaluated once over the
+whole filled DataFrame with pandas column operations, so no Excel is needed.
+
+Supported subset: & + - * / comparisons, CHAR, LEN, IF, TRIM, SUBSTITUTE,
+CONCAT/CONCATENATE and cell references like B2 / $B$2 on the same sheet.
+"""
+import math
+import re
+import zipfile
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.utils import column_index_from_string
+
+
+class FormulaError(ValueError):
+    pass
+
+
+_TOKEN_RE = re.compile(
+    r"""
+    (?P<ws>\s+)
+  | (?P<string>"(?:[^"]|"")*")
+  | (?P<func>[A-Za-z_][A-Za-z0-9_.]*)(?=\s*\()
+  | (?P<ref>\$?[A-Za-z]{1,3}\$?[0-9]+)(?![A-Za-z0-9_!:(])
+  | (?P<number>[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)
+  | (?P<bool>TRUE|FALSE)\b
+  | (?P<op><>|<=|>=|[&=<>+\-*/(),])
+    """,
+    re.VERBOSE | re.IGNORECASE,
+)
+
+_REF_RE = re.compile(r"(\$?)([A-Za-z]{1,3})(\$?)([0-9]+)")
+
+_FUNCTIONS = {"CHAR", "LEN", "IF", "TRIM", "SUBSTITUTE", "CONCAT", "CONCATENATE"}
+
+_COMPARE_OPS = {"=", "<>", "<", ">", "<=", ">="}
+
+# A formula cell's <f> element in sheet XML (any namespace prefix)
+_FORMULA_TAG_RE = re.compile(rb"<(?:\w+:)?f[\s>/]")
+
+# Bytes of sheet XML searched at a time
+_SCAN_BLOCK_BYTES = 1 << 20
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = _TOKEN_RE.match(text, pos)
+        if not m:
+            raise FormulaError(f"模板内容列公式不支持: {text} (位置 {pos})")
+        pos = m.end()
+        kind = m.lastgroup
+        if kind != "ws":
+            tokens.append((kind, m.group(kind)))
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser producing hashable tuple trees."""
+
+    def __init__(self, text, sheet_row):
+        self.text = text
+        self.sheet_row = sheet_row
+        self.tokens = _tokenize(text)
+        self.pos = 0
+
+    def parse(self):
+        node = self._comparison()
+        if self.pos != len(self.tokens):
+            self._fail()
+        return node
+
+    def _fail(self):
+        raise FormulaError(f"模板内容列公式不支持: ={self.text}")
+
+    def _peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def _take_op(self, ops):
+        kind, value = self._peek()
+        if kind == "op" and value in ops:
+            self.pos += 1
+            return value
+        return None
+
+    def _expect(self, op):
+        if self._take_op({op}) is None:
+            self._fail()
+
+    def _comparison(self):
+        node = self._concat()
+        while True:
+            op = self._take_op(_COMPARE_OPS)
+            if op is None:
+                return node
+            node = ("op", op, node, self._concat())
+
+    def _concat(self):
+        node = self._additive()
+        while self._take_op({"&"}):
+            node = ("op", "&", node, self._additive())
+        return node
+
+    def _additive(self):
+        node = self._term()
+        while True:
+            op = self._take_op({"+", "-"})
+            if op is None:
+                return node
+            node = ("op", op, node, self._term())
+
+    def _term(self):
+        node = self._unary()
+        while True:
+            op = self._take_op({"*", "/"})
+            if op is None:
+                return node
+            node = ("op", op, node, self._unary())
+
+    def _unary(self):
+        op = self._take_op({"-", "+"})
+        if op == "-":
+            return ("neg", self._unary())
+        if op == "+":
+            return self._unary()
+        return self._primary()
+
+    def _primary(self):
+        kind, value = self._peek()
+        if kind is None:
+            self._fail()
+        self.pos += 1
+
+        if kind == "string":
+            return ("const", value[1:-1].replace('""', '"'))
+        if kind == "number":
+            return ("const", float(value))
+        if kind == "bool":
+            return ("const", value.upper() == "TRUE")
+        if kind == "ref":
+            return self._ref(value)
+        if kind == "func":
+            return self._call(value)
+        if kind == "op" and value == "(":
+            node = self._comparison()
+            self._expect(")")
+            return node
+        self.pos -= 1
+        self._fail()
+
+    def _ref(self, value):
+        col_abs, letters, row_abs, row = _REF_RE.fullmatch(value).groups()
+        col = column_index_from_string(letters.upper()) - 1
+        row = int(row)
+        if row_abs:
+            return ("ref", col, "abs", row)
+        # Relative rows are stored as an offset, so the same formula filled
+        # down a column compiles to the same tree on every row
+        return ("ref", col, "rel", row - self.sheet_row)
+
+    def _call(self, name):
+        name = name.upper()
+        if name.startswith("_XLFN."):
+            name = name[len("_XLFN."):]
+        if name not in _FUNCTIONS:
+            raise FormulaError(f"模板内容列公式不支持函数 {name}: ={self.text}")
+
+        self._expect("(")
+        args = []
+        if self._take_op({")"}) is None:
+            while True:
+                kind, value = self._peek()
+                if kind == "op" and value in (",", ")"):
+                    args.append(("const", None))  # omitted argument
+                else:
+                    args.append(self._comparison())
+                if self._take_op({")"}):
+                    break
+                self._expect(",")
+        return ("call", name, tuple(args))
+
+
+def compile_formula(text, sheet_row):
+    """Compile formula text (with or without leading '=') written on `sheet_row`."""
+    if text.startswith("="):
+        text = text[1:]
+    return _Parser(text, sheet_row).parse()
+
+
+def has_formulas(template_file):
+    """
+    Cheap check for formula cells: the worksheet XML of the xlsx is
+    streamed and searched for <f> elements, without parsing the sheet.
+    Anything that is not a readable xlsx counts as having formulas.
+    """
+    if hasattr(template_file, "seek"):
+        template_file.seek(0)
+    try:
+        with zipfile.ZipFile(template_file) as zf:
+            for name in zf.namelist():
+                if not (name.startswith("xl/worksheets/") and name.endswith(".xml")):
+                    continue
+                with zf.open(name) as f:
+                    tail = b""
+                    while True:
+                        block = f.read(_SCAN_BLOCK_BYTES)
+                        if not block:
+                            break
+                        if _FORMULA_TAG_RE.search(tail + block):
+                            return True
+                        tail = block[-16:]
+        return False
+    except (zipfile.BadZipFile, OSError):
+        return True
+    finally:
+        if hasattr(template_file, "seek"):
+            template_file.seek(0)
+
+
+def read_content_formulas(template_file, col_idx, n_rows):
+    """
+    Read the raw formula text of column `col_idx` for the first `n_rows`
+    data rows (sheet rows 2..n_rows+1).
+    Returns: { row_position: formula_text }
+    """
+    if hasattr(template_file, "seek"):
+        template_file.seek(0)
+    wb = load_workbook(template_file, read_only=True, data_only=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        formulas = {}
+        rows = ws.iter_rows(min_row=2, max_row=n_rows + 1, values_only=True)
+        for pos, row in enumerate(rows):
+            if col_idx < len(row):
+                value = row[col_idx]
+                if isinstance(value, str) and value.startswith("="):
+                    formulas[pos] = value
+        return formulas
+    finally:
+        wb.close()
+        if hasattr(template_file, "seek"):
+            template_file.seek(0)
+
+
+def compile_content_formulas(template_file, col_idx, n_rows):
+    """
+    Compile the 内容 column formulas of a template.
+    Rows sharing the same formula (relative to their own row) share one program.
+    Returns: [(program, row_positions), ...], empty when the column has no formulas.
+    """
+    # The openpyxl pass reads the whole sheet again, skip it when there is nothing to find
+    if not has_formulas(template_file):
+        return []
+    programs = {}
+    for pos, text in read_content_formulas(template_file, col_idx, n_rows).items():
+        program = compile_formula(text, sheet_row=pos + 2)
+        programs.setdefault(program, []).append(pos)
+    return [(program, np.array(rows)) for program, rows in programs.items()]
+
+
+# ---------------------------------------------------------------------------
+# Evaluation. Values are either Python scalars or object Series aligned on a
+# RangeIndex over the filled frame.
+# ---------------------------------------------------------------------------
+
+def _is_empty(x):
+    return x is None or (isinstance(x, float) and math.isnan(x)) or x is pd.NA
+
+
+def _scalar_text(x):
+    if _is_empty(x):
+        return ""
+    if isinstance(x, (bool, np.bool_)):
+        return "TRUE" if x else "FALSE"
+    if isinstance(x, (float, np.floating)):
+        if float(x).is_integer():
+            return str(int(x))
+        return format(float(x), ".15g")
+    return str(x)
+
+
+def _scalar_num(x):
+    if _is_empty(x) or x == "":
+        return 0.0
+    if isinstance(x, (bool, np.bool_)):
+        return float(x)
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return float("nan")  # #VALUE!
+
+
+def _text(v):
+    if not isinstance(v, pd.Series):
+        return _scalar_text(v)
+    if pd.api.types.infer_dtype(v, skipna=True) in ("string", "empty"):
+        return v.astype(object).where(v.notna(), "")
+    return v.map(_scalar_text).astype(object)
+
+
+def _num(v):
+    if not isinstance(v, pd.Series):
+        return _scalar_num(v)
+    if pd.api.types.is_numeric_dtype(v) and not pd.api.types.is_bool_dtype(v):
+        return v.astype(float).fillna(0.0)
+    return v.map(_scalar_num).astype(float)
+
+
+def _truth(v):
+    if not isinstance(v, pd.Series):
+        if isinstance(v, str):
+            return v.upper() == "TRUE"
+        return bool(_scalar_num(v))
+    if pd.api.types.is_bool_dtype(v):
+        return v
+    return v.map(_truth).astype(bool)
+
+
+def _is_textual(v):
+    if isinstance(v, pd.Series):
+        return pd.api.types.infer_dtype(v, skipna=True) == "string"
+    return isinstance(v, str)
+
+
+def _compare(op, a, b):
+    if _is_textual(a) or _is_textual(b):
+        # Excel compares text case-insensitively
+        a, b = _text(a), _text(b)
+        a = a.str.lower() if isinstance(a, pd.Series) else a.lower()
+        b = b.str.lower() if isinstance(b, pd.Series) else b.lower()
+    else:
+        a, b = _num(a), _num(b)
+    if op == "=":
+        return a == b
+    if op == "<>":
+        return a != b
+    if op == "<":
+        return a < b
+    if op == ">":
+        return a > b
+    if op == "<=":
+        return a <= b
+    return a >= b
+
+
+def _arith(op, a, b):
+    a, b = _num(a), _num(b)
+    if op == "+":
+        return a + b
+    if op == "-":
+        return a - b
+    if op == "*":
+        return a * b
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if isinstance(a, pd.Series) or isinstance(b, pd.Series):
+            return (a / b).replace([np.inf, -np.inf], np.nan)
+        return a / b if b else float("nan")  # #DIV/0!
+
+
+def _broadcast(v, index):
+    if isinstance(v, pd.Series):
+        return v
+    return pd.Series([v] * len(index), index=index, dtype=object)
+
+
+def _elementwise(func, args, index):
+    """Apply a scalar function row by row when an argument is a Series."""
+    if not any(isinstance(a, pd.Series) for a in args):
+        return func(*args)
+    columns = [_broadcast(a, index) for a in args]
+    return pd.Series([func(*row) for row in zip(*columns)], index=index, dtype=object)
+
+
+def _substitute(text, old, new, instance=None):
+    text, old, new = _scalar_text(text), _scalar_text(old), _scalar_text(new)
+    if old == "":
+        return text
+    if _is_empty(instance):
+        return text.replace(old, new)
+    n = int(_scalar_num(instance))
+    start = -1
+    for _ in range(n):
+        start = text.find(old, start + 1)
+        if start < 0:
+            return text
+    return text[:start] + new + text[start + len(old):]
+
+
+def _call(name, args, index):
+    if name == "CHAR":
+        return _elementwise(lambda n: chr(int(_scalar_num(n))), args[:1], index)
+    if name == "LEN":
+        t = _text(args[0])
+        return t.str.len() if isinstance(t, pd.Series) else len(t)
+    if name == "TRIM":
+        # Excel TRIM only touches the space character
+        t = _text(args[0])
+        if isinstance(t, pd.Series):
+            return t.str.strip(" ").str.replace(r" {2,}", " ", regex=True)
+        return re.sub(r" {2,}", " ", t.strip(" "))
+    if name == "SUBSTITUTE":
+        if len(args) == 3 and not any(isinstance(a, pd.Series) for a in args[1:]):
+            old, new = _scalar_text(args[1]), _scalar_text(args[2])
+            t = _text(args[0])
+            if not old:
+                return t
+            if isinstance(t, pd.Series):
+                return t.str.replace(old, new, regex=False)
+            return t.replace(old, new)
+        return _elementwise(_substitute, args, index)
+    if name in ("CONCAT", "CONCATENATE"):
+        result = ""
+        for a in args:
+            result = result + _text(a)
+        return result
+    if name == "IF":
+        cond = _truth(args[0])
+        yes = args[1] if len(args) > 1 else True
+        no = args[2] if len(args) > 2 else False
+        if not isinstance(cond, pd.Series):
+            return yes if cond else no
+        return _broadcast(yes, index).where(cond, _broadcast(no, index))
+    raise FormulaError(f"模板内容列公式不支持函数 {name}")
+
+
+def _evaluate(node, frame):
+    kind = node[0]
+    if kind == "const":
+        return node[1]
+    if kind == "ref":
+        _, col, mode, row = node
+        if col >= frame.shape[1]:
+            return None
+        if mode == "abs":
+            if row == 1:
+                return str(frame.columns[col])  # header cell
+            pos = row - 2
+            return frame.iat[pos, col] if 0 <= pos < len(frame) else None
+        series = frame.iloc[:, col].astype(object)
+        return series.shift(-row) if row else series
+    if kind == "neg":
+        return -_num(_evaluate(node[1], frame))
+    if kind == "op":
+        _, op, left, right = node
+        a, b = _evaluate(left, frame), _evaluate(right, frame)
+        if op == "&":
+            return _text(a) + _text(b)
+        if op in _COMPARE_OPS:
+            return _compare(op, a, b)
+        return _arith(op, a, b)
+    if kind == "call":
+        _, name, arg_nodes = node
+        return _call(name, [_evaluate(a, frame) for a in arg_nodes], frame.index)
+    raise FormulaError(f"Unknown formula node {kind}")
+
+
+def evaluate_formula(program, frame):
+    """Evaluate one compiled formula for every row of `frame` at once."""
+    frame = frame.reset_index(drop=True)
+    return _broadcast(_evaluate(program, frame), frame.index)
+
+
+def evaluate_content(programs, frame, existing, positions=None):
+    """
+    Compute the 内容 column from compiled formulas.
+    Rows with a formula get its value, other rows keep `existing`.
+    `frame` may hold just some template rows, `positions` being their row
+    positions in the template (only valid when every program is_row_local()).
+    """
+    result = existing.astype(object).to_numpy(copy=True)
+    for program, rows in programs:
+        if positions is not None:
+            rows = np.flatnonzero(np.isin(positions, rows))
+        values = evaluate_formula(program, frame).to_numpy()
+        result[rows] = values[rows]
+    return pd.Series(result, index=frame.index, dtype=object)
+
+
+def is_row_local(program):
+    """True if the formula only reads cells of its own row (no offsets, no $-rows)."""
+    kind = program[0]
+    if kind == "ref":
+        _, _, mode, row = program
+        return mode == "rel" and row == 0 or mode == "abs" and row == 1
+    if kind == "neg":
+        return is_row_local(program[1])
+    if kind == "op":
+        return is_row_local(program[2]) and is_row_local(program[3])
+    if kind == "call":
+        return all(is_row_local(arg) for arg in program[2])
+    return True
+
+
+def splices_column(program, col):
+    """
+    True if the formula only uses column `col` of its own row as text
+    spliced into the result (through &, CONCAT or an IF branch), never
+    inspecting it (LEN, SUBSTITUTE, comparisons, IF conditions ...).
+    The result is then prefix & cell & suffix, whatever the cell holds.
+    """
+    def walk(node, spliced):
+        kind = node[0]
+        if kind == "ref":
+            _, ref_col, mode, row = node
+            return spliced or not (ref_col == col and mode == "rel" and row == 0)
+        if kind == "neg":
+            return walk(node[1], False)
+        if kind == "op":
+            keep = spliced and node[1] == "&"
+            return walk(node[2], keep) and walk(node[3], keep)
+        if kind == "call":
+            _, name, args = node
+            if name in ("CONCAT", "CONCATENATE"):
+                return all(walk(a, spliced) for a in args)
+            if name == "IF":
+                return walk(args[0], False) and all(walk(a, spliced) for a in args[1:])
+            return all(walk(a, False) for a in args)
+        return True
+    return walk(program, True)
@@ -0,0 +1,99 @@
+"""
+Lightweight per-stage instrumentation for the processing pipeline.
+
+    recorder = StageRecorder(hook=send_to_metrics)
+    with recorder.stage("read_source") as stage:
+        links = ...
+        stage["rows"] = len(links)
+
+Each stage records wall time, rows processed, the process RSS high-water
+mark (rss_hwm_mb: ru_maxrss, the peak over the process lifetime, not the
+stage) and how far the stage raised it (rss_hwm_growth_mb: 0 when the
+stage stayed below an earlier peak). With trace_memory=True the Python
+allocation peak of every stage is recorded as well (alloc_peak_mb,
+tracemalloc, noticeably slower, meant for diagnosis; batch.py and
+service.py turn it on with --trace-memory).
+"""
+import json
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _rss_hwm_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+class StageRecorder:
+    """Collects one record per pipeline stage and forwards it to `hook`."""
+
+    def __init__(self, hook=None, trace_memory=False):
+        self.hook = hook
+        self.trace_memory = trace_memory
+        self.records = []
+        self._current = None
+
+    def begin(self, name, rows=None):
+        """Start a stage (closing the previous one if still open)."""
+        if self._current is not None:
+            self.end()
+        record = {"stage": name, "rows": rows}
+        if self.trace_memory:
+            record["_own_tracing"] = not tracemalloc.is_tracing()
+            if record["_own_tracing"]:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        record["_hwm_start"] = _rss_hwm_mb()
+        record["_started"] = time.perf_counter()
+        self._current = record
+        return record
+
+    def end(self, rows=None):
+        """Finish the current stage and return its record."""
+        record = self._current
+        if record is None:
+            return None
+        self._current = None
+        record["seconds"] = round(time.perf_counter() - record.pop("_started"), 4)
+        if rows is not None:
+            record["rows"] = rows
+        hwm_start = record.pop("_hwm_start")
+        record["rss_hwm_mb"] = _rss_hwm_mb()
+        if hwm_start is not None:
+            record["rss_hwm_growth_mb"] = round(record["rss_hwm_mb"] - hwm_start, 1)
+        if "_own_tracing" in record:
+            record["alloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 2)
+            if record.pop("_own_tracing"):
+                tracemalloc.stop()
+        self.records.append(record)
+        if self.hook is not None:
+            self.hook(record)
+        return record
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        record = self.begin(name, rows)
+        try:
+            yield record
+        finally:
+            self.end()
+
+    @property
+    def total_seconds(self):
+        return round(sum(r["seconds"] for r in self.records), 4)
+
+    def to_dict(self):
+        return {"stages": list(self.records), "total_seconds": self.total_seconds}
+
+    def to_json(self, **kwargs):
+        return json.dumps(self.to_dict(), ensure_ascii=False, **kwargs)
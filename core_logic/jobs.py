@@ -0,0 +1,110 @@
+"""
+Background jobs for the Streamlit app.
+
+The analysis runs on a thread pool owned by one JobManager per server
+process (shared across sessions), so a long analysis neither blocks the
+session's script run nor restarts when a widget triggers a rerun. Progress
+comes from the pipeline's StageRecorder hook, which is also where a
+cancelled job stops: the next finished stage raises JobCancelled.
+"""
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from instrument import StageRecorder
+except ImportError:
+    from core_logic.instrument import StageRecorder
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, expected_stages):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"  # queued / running / done / error / cancelled
+        self.stage = None
+        self.expected_stages = expected_stages
+        self.result = None
+        self.error = None
+        self.recorder = StageRecorder(hook=self._on_stage)
+        self.finished_at = None
+        self._cancel = threading.Event()
+
+    @property
+    def progress(self):
+        """Fraction of stages finished, 1.0 only once the job is done."""
+        if self.status == "done":
+            return 1.0
+        done = len(self.recorder.records)
+        return min(done / max(self.expected_stages, 1), 0.99)
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def cancel(self):
+        self._cancel.set()
+
+    def _on_stage(self, record):
+        self.stage = record["stage"]
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def _run(self, fn, args, kwargs):
+        if self._cancel.is_set():
+            self.status = "cancelled"
+            self.finished_at = time.time()
+            return
+        self.status = "running"
+        try:
+            self.result = fn(*args, recorder=self.recorder, **kwargs)
+            self.status = "done"
+        except JobCancelled:
+            self.status = "cancelled"
+        except Exception as e:
+            self.error = e
+            self.status = "error"
+        finally:
+            self.finished_at = time.time()
+
+
+class JobManager:
+    """
+    Runs pipeline functions in the background.
+    `fn` must accept a `recorder` keyword (see instrument.StageRecorder).
+    Finished jobs are forgotten after `keep_seconds`.
+    """
+
+    def __init__(self, max_workers=2, keep_seconds=3600):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sms-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.keep_seconds = keep_seconds
+
+    def submit(self, fn, *args, expected_stages=1, **kwargs):
+        self._prune()
+        job = Job(expected_stages)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._executor.submit(job._run, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def forget(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def _prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self._lock:
+            stale = [jid for jid, job in self._jobs.items()
+                     if job.finished and job.finished_at < cutoff]
+            for jid in stale:
+                del self._jobs[jid]
@@ -0,0 +1,153 @@
+"""
+On-disk registry of exported short links.
+
+A short link must never be sent twice. Every exported link is recorded in
+one SQLite table keyed by the link (WITHOUT ROWID: the table is the
+primary-key B-tree itself), together with the campaign and group it went
+out with. An analysis checks its whole link column at once: the distinct
+links are bulk-loaded into a temporary table and joined against the
+registry, one indexed lookup per link, which stays fast with tens of
+millions of historical links.
+
+    registry = LinkRegistry()                  # SMS_LINK_REGISTRY or ~/.sms_link_registry.sqlite3
+    duplicates = registry.find(links)          # DataFrame, empty when all links are new
+    registry.record("海灯节_US", [(gid, group_links), ...])
+"""
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+import pandas as pd
+
+DEFAULT_PATH = os.environ.get(
+    "SMS_LINK_REGISTRY", os.path.join(os.path.expanduser("~"), ".sms_link_registry.sqlite3")
+)
+
+# What an analysis does with links found in the registry
+DUPLICATE_POLICIES = ("flag", "reject")
+
+DUPLICATE_COLUMNS = ["link", "campaign", "group", "exported_at"]
+
+# Rows per executemany batch
+BATCH_ROWS = 50000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS links (
+    link TEXT PRIMARY KEY,
+    campaign TEXT NOT NULL,
+    group_id TEXT,
+    exported_at REAL NOT NULL
+) WITHOUT ROWID
+"""
+
+
+class DuplicateLinksError(ValueError):
+    """Raised by a "reject" analysis, `duplicates` holds the reused links."""
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        first = duplicates.iloc[0]
+        super().__init__(
+            f"{len(duplicates)} 条短链已在以往活动中导出过 (例如 {first['link']} -> {first['campaign']})"
+        )
+
+    def __reduce__(self):
+        # Travels back from worker processes (batch.py, service.py)
+        return (DuplicateLinksError, (self.duplicates,))
+
+
+def _distinct(links):
+    values = pd.unique(pd.Series(links, dtype=object).dropna().astype(str))
+    return values[values != ""]
+
+
+def _batches(values, size=BATCH_ROWS):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+class LinkRegistry:
+    """
+    Registry of exported links in the SQLite file at `path`.
+    Every call opens its own connection, so one registry can be shared by
+    threads and pickled to worker processes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_PATH
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            # WAL: checks keep reading while another process records
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(_SCHEMA)
+
+    def __reduce__(self):
+        return (LinkRegistry, (self.path,))
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self.path, timeout=60)) as conn:
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:  # commit, or roll back on error
+                yield conn
+
+    def _load_candidates(self, conn, links):
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS candidates (link TEXT, group_id TEXT)")
+        conn.execute("DELETE FROM temp.candidates")
+        for batch in _batches(links):
+            conn.executemany("INSERT INTO temp.candidates VALUES (?, ?)", batch)
+
+    def _conflicts(self, conn, campaign=None):
+        # candidates drive the join, links is probed through its primary key
+        query = ("SELECT l.link, l.campaign, l.group_id, l.exported_at "
+                 "FROM temp.candidates c CROSS JOIN links l ON l.link = c.link")
+        params = ()
+        if campaign is not None:
+            query += " WHERE l.campaign != ?"
+            params = (campaign,)
+        frame = pd.DataFrame(conn.execute(query, params).fetchall(), columns=DUPLICATE_COLUMNS)
+        frame["exported_at"] = pd.to_datetime(frame["exported_at"], unit="s")
+        return frame
+
+    def find(self, links):
+        """
+        Links of `links` already in the registry.
+        Returns: DataFrame [link, campaign, group, exported_at], empty if none
+        """
+        values = _distinct(links)
+        with self._connect() as conn:
+            self._load_candidates(conn, [(link, None) for link in values])
+            return self._conflicts(conn)
+
+    def record(self, campaign, groups):
+        """
+        Record the exported links of `campaign`, `groups` is an iterable of
+        (group_id, links). A link keeps its first campaign.
+        The check and the insert share one write transaction, so links
+        another process recorded since the analysis are still reported.
+        Returns: DataFrame of links that were already exported by another
+        campaign (see find)
+        """
+        rows = []
+        for gid, links in groups:
+            rows.extend((link, str(gid)) for link in _distinct(links))
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._load_candidates(conn, rows)
+            conflicts = self._conflicts(conn, campaign)
+            conn.execute(
+                "INSERT OR IGNORE INTO links SELECT link, ?, group_id, ? FROM temp.candidates",
+                (campaign, time.time()),
+            )
+        return conflicts
+
+    def forget(self, campaign):
+        """Remove a campaign's links (e.g. a campaign that was never sent)."""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM links WHERE campaign = ?", (campaign,)).rowcount
+
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM links").fetchone()[0]
@@ -1,89 +1,545 @@
+import numpy as np
 import pandas as pd
 import os
 import io
+import hashlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
-def process_excel_cloud(source_file, template_file, output_dir=None):
+try:
+    from source_reader import read_links, read_links_many, is_multi_source
+    from exporter import encode_parts, export_parts, iter_parts, write_zip_bundle, frame_digest
+    from formula import evaluate_content, is_row_local, splices_column
+    from template_plan import load_template_plan, compact_frame
+    from instrument import StageRecorder
+    from sms_segments import count_segments, text_units, units_segments
+    from link_registry import DUPLICATE_POLICIES, DuplicateLinksError
+except ImportError:
+    from core_logic.source_reader import read_links, read_links_many, is_multi_source
+    from core_logic.exporter import encode_parts, export_parts, iter_parts, write_zip_bundle, frame_digest
+    from core_logic.formula import evaluate_content, is_row_local, splices_column
+    from core_logic.template_plan import load_template_plan, compact_frame
+    from core_logic.instrument import StageRecorder
+    from core_logic.sms_segments import count_segments, text_units, units_segments
+    from core_logic.link_registry import DUPLICATE_POLICIES, DuplicateLinksError
+
+# Stages recorded by build_groups(), in order (see instrument.StageRecorder).
+# The lazy path has no fill/compute_content stages, that work happens when a
+# group is read (preview/export), so progress counts against this are an upper bound.
+ANALYSIS_STAGES = ("read_source", "read_template", "fill", "compute_content", "filter", "check_links", "group", "segments")
+
+# Rows of 内容 classified at a time when counting SMS segments
+SEGMENT_BLOCK_ROWS = 100000
+
+# Stands in for the link when 内容 is split around it (Unicode private use area)
+LINK_SENTINEL = "\ue000"
+
+# Rows of built group frames a LazyGroupedResult keeps between reads.
+# Exports read every group once, so they must not pin all of them.
+FRAME_CACHE_ROWS = int(os.environ.get("SMS_FRAME_CACHE_ROWS", 200000))
+
+def partition_order(keys):
     """
-    Cloud-optimized Excel processor.
-    Returns a dictionary of {filename: excel_bytes} for easy download in Streamlit,
-    or saves to output_dir if provided.
+    Group order of `keys` in a single pass.
+    The keys are hashed once (pd.factorize) and sorted once with a stable
+    sort, so the cost does not grow with the number of groups.
+    Rows with an empty key are dropped. Groups keep first-appearance order.
+    Returns: (row positions in group order, { group_id: (start, stop) })
     """
-    print("Starting Cloud Processing...")
-    
-    # 1. Read Source (allow file path or bytes)
-    source_df = pd.read_excel(source_file)
+    codes, uniques = pd.factorize(np.asarray(keys), sort=False)
+    order = np.argsort(codes, kind="stable")
+
+    # Empty keys get code -1 and sort to the front
+    skip = int(np.count_nonzero(codes < 0))
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+
+    ranges = {}
+    start = 0
+    for gid, count in zip(uniques, counts):
+        stop = start + int(count)
+        ranges[gid] = (start, stop)
+        start = stop
+    return order[skip:], ranges
+
+def partition_ranges(frame, keys):
+    """
+    Reorder `frame` by `keys` in a single pass (see partition_order).
+    Returns: (ordered frame, { group_id: (start, stop) })
+    """
+    order, ranges = partition_order(keys)
+    return frame.take(order), ranges
+
+def partition_groups(frame, keys):
+    """
+    Split `frame` into groups by `keys` in a single pass, every group is a
+    slice of one reordered frame (see partition_ranges).
+    Returns: [(group_id, DataFrame slice), ...]
+    """
+    ordered, ranges = partition_ranges(frame, keys)
+    return [(gid, ordered.iloc[start:stop]) for gid, (start, stop) in ranges.items()]
+
+def default_name(gid, fmt="xlsx"):
+    return f"output_group_{gid}.{fmt}"
+
+class GroupedResult(Mapping):
+    """
+    Grouped analysis result stored once: a single backing frame ordered by
+    文案 (repeated text columns dictionary-encoded) and a (start, stop) row
+    range per group.
+    Behaves like the { group_id: {"default_name": str, "data": DataFrame} }
+    dict returned before; a group's frame is only sliced out when accessed.
+    """
+
+    def __init__(self, frame, ranges, fingerprint=None, changed=None, links=None):
+        self.frame = frame
+        self.ranges = ranges
+        # Filled links by template row, the frame's index is the template row
+        self.links = np.asarray([] if links is None else links, dtype=object)
+        # Source/template fingerprint for incremental re-runs (see build_groups)
+        self.fingerprint = fingerprint
+        # Groups patched by an incremental run, None after a full run
+        self.changed = changed
+        # Billed SMS segments per row in group order (see compute_segments)
+        self.segments = None
+        # Links already in the link registry (DataFrame), None if not checked
+        self.duplicates = None
+        self._digests = {}
+
+    def __getitem__(self, gid):
+        return {"default_name": default_name(gid), "data": self.group_frame(gid)}
+
+    def group_label(self, gid):
+        return str(gid)
+
+    def default_name(self, gid, fmt="xlsx"):
+        return default_name(gid, fmt)
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def row_count(self, gid):
+        start, stop = self.ranges[gid]
+        return stop - start
+
+    def group_frame(self, gid):
+        start, stop = self.ranges[gid]
+        return self.frame.iloc[start:stop]
+
+    def preview(self, gid, n=5):
+        start, stop = self.ranges[gid]
+        return self.frame.iloc[start:min(stop, start + n)]
+
+    def frames(self):
+        """[(group_id, DataFrame), ...] in group order."""
+        return [(gid, self.group_frame(gid)) for gid in self.ranges]
+
+    def _positions(self, gid):
+        # Template rows of a group
+        start, stop = self.ranges[gid]
+        return self.frame.index.to_numpy()[start:stop]
+
+    def group_links(self, gid):
+        """Links filled into a group's rows (rows past the source have none)."""
+        positions = self._positions(gid)
+        return self.links[positions[positions < len(self.links)]]
+
+    def link_groups(self):
+        """[(group_id, links), ...] for link_registry.LinkRegistry.record."""
+        return [(gid, self.group_links(gid)) for gid in self.ranges]
+
+    def _links_key(self, gid):
+        # A 内容 formula may read other rows, so every link counts
+        return self.fingerprint["links_digest"]
+
+    def group_digest(self, gid):
+        """
+        Content key of a group that doesn't build its frame: the template,
+        the group and the links it depends on. Used to cache encoded
+        downloads (see app.py); without a fingerprint the frame is hashed.
+        """
+        digest = self._digests.get(gid)
+        if digest is None:
+            if self.fingerprint is None:
+                digest = frame_digest(self.group_frame(gid))
+            else:
+                key = f"{self.fingerprint['template']}\n{gid}\n{self._links_key(gid)}"
+                digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+            self._digests[gid] = digest
+        return digest
+
+    def _content(self, gid, start, stop):
+        # 内容 is always the last export column
+        return self.frame.iloc[start:stop, -1]
+
+    def compute_segments(self, gids=None):
+        """
+        Count billed SMS segments of every row of `gids` (all groups by
+        default) into self.segments, SEGMENT_BLOCK_ROWS rows at a time.
+        """
+        total = sum(stop - start for start, stop in self.ranges.values())
+        if self.segments is None or len(self.segments) != total:
+            self.segments = np.zeros(total, dtype=np.int32)
+        for gid in (self.ranges if gids is None else gids):
+            start, stop = self.ranges[gid]
+            for block in range(start, stop, SEGMENT_BLOCK_ROWS):
+                block_stop = min(block + SEGMENT_BLOCK_ROWS, stop)
+                self.segments[block:block_stop] = count_segments(self._content(gid, block, block_stop))
+        return self.segments
+
+    def row_segments(self, gid):
+        """SMS segments of each row of a group (None before compute_segments)."""
+        if self.segments is None:
+            return None
+        start, stop = self.ranges[gid]
+        return self.segments[start:stop]
+
+    def segment_total(self, gid):
+        """Billed SMS segments of a whole group (None before compute_segments)."""
+        segments = self.row_segments(gid)
+        return None if segments is None else int(segments.sum())
+
+class LazyGroupedResult(GroupedResult):
+    """
+    Preview-first GroupedResult. Only the group keys and row ranges are
+    computed up front, from the 文案/语言/区域 columns; a group's links and
+    内容 are filled in when the group is read, and preview() builds just
+    the rows it shows. Used whenever every 内容 formula is row-local.
+    Built groups are kept in a small LRU cache (FRAME_CACHE_ROWS rows), so
+    exporting every group never holds all full frames at once.
+    `rows` are template row positions in group order.
+    """
+
+    def __init__(self, plan, links, rows, ranges, export_cols, fingerprint=None, changed=None):
+        self.plan = plan
+        self.links = np.asarray(links, dtype=object)
+        self.rows = rows
+        self.ranges = ranges
+        self.export_cols = export_cols
+        self.fingerprint = fingerprint
+        self.changed = changed
+        self.segments = None
+        self.duplicates = None
+        self._digests = {}
+        self._frames = OrderedDict()
+        self._cached_rows = 0
+
+    def _build(self, positions):
+        plan = self.plan
+        filled = plan.frame.take(positions)
+        has_link = positions < len(self.links)
+        if has_link.any():
+            col_link = plan.columns["link"]
+            values = filled[col_link].to_numpy(dtype=object, copy=True)
+            values[has_link] = self.links[positions[has_link]]
+            filled[col_link] = values
+        content = compute_content(plan, filled, positions)
+        filled[self.export_cols[-1]] = content
+        return filled[self.export_cols]
+
+    def _positions(self, gid):
+        start, stop = self.ranges[gid]
+        return self.rows[start:stop]
+
+    def _links_key(self, gid):
+        # Row-local 内容, only the group's own links count
+        return links_digest(self.group_links(gid))
+
+    def _cache(self, gid, frame):
+        if len(frame) > FRAME_CACHE_ROWS:
+            return
+        self._frames[gid] = frame
+        self._cached_rows += len(frame)
+        while self._cached_rows > FRAME_CACHE_ROWS:
+            _, dropped = self._frames.popitem(last=False)
+            self._cached_rows -= len(dropped)
+
+    def group_frame(self, gid):
+        frame = self._frames.get(gid)
+        if frame is not None:
+            self._frames.move_to_end(gid)
+            return frame
+        start, stop = self.ranges[gid]
+        frame = self._build(self.rows[start:stop])
+        self._cache(gid, frame)
+        return frame
+
+    def preview(self, gid, n=5):
+        if gid in self._frames:
+            return self._frames[gid].iloc[:n]
+        start, stop = self.ranges[gid]
+        return self._build(self.rows[start:min(stop, start + n)])
+
+    def _content(self, gid, start, stop):
+        # Reuse a built group, otherwise build just these rows and drop them
+        frame = self._frames.get(gid)
+        if frame is not None:
+            group_start = self.ranges[gid][0]
+            return frame.iloc[start - group_start:stop - group_start, -1]
+        return self._build(self.rows[start:stop]).iloc[:, -1]
+
+    @property
+    def frame(self):
+        """All groups in one frame (materializes every group)."""
+        if not self.ranges:
+            return pd.DataFrame(columns=self.export_cols)
+        return pd.concat([self.group_frame(gid) for gid in self.ranges])
+
+def compute_content(plan, filled_df, positions=None):
+    """
+    Compute 内容 for `filled_df`, whose rows are the template rows at
+    `positions` (all template rows when None).
+    Use the template's own 内容 formulas when it has them (compiled and
+    evaluated column-wise), otherwise the standard formula:
+    =B2&CHAR(10)&C2&D2&" "&CHAR(10)&E2
+    """
+    col_content = plan.columns["content"]
+    programs = plan.programs
+    if programs:
+        return evaluate_content(programs, filled_df, filled_df[col_content], positions)
+
+    # Vectorized computation
+    def get_str(col):
+        if col: return filled_df[col].astype(object).fillna("").astype(str)
+        return pd.Series([""] * len(filled_df), index=filled_df.index)
+
+    b_val = get_str(plan.columns["body"])
+    c_val = get_str(plan.columns["back"])
+    d_val = get_str(plan.columns["link"]) # The links we just filled
+    e_val = get_str(plan.columns["unsub"])
     
-    # Identify Link Column in Source
+    # Formula logic
+    # B + \n + C + D + " " + \n + E
+    newline = "\n"
+    return b_val + newline + c_val + d_val + " " + newline + e_val
+
+def _spliced_segments(plan, links, positions):
+    """
+    SMS segments of the template rows at `positions` without building their
+    内容. When every 内容 formula only splices the link in (see
+    formula.splices_column), a row's 内容 is its template text with the link
+    inserted k times: the template text is computed once per distinct
+    template row and combined with the size of each row's link.
+    Returns: segments per position (int32 ndarray), None if a formula
+    inspects the link
+    """
+    frame = plan.frame
+    col_link = plan.columns["link"]
+    if col_link is None:
+        has_link = np.zeros(len(positions), dtype=bool)
+    else:
+        link_idx = frame.columns.get_loc(col_link)
+        if not all(splices_column(program, link_idx) for program, _ in plan.programs):
+            return None
+        has_link = positions < len(links)
+
+    # Distinct template rows: same cells, same formula, filled or not
+    cells = frame.take(positions)
+    if col_link is not None:
+        values = cells[col_link].to_numpy(dtype=object, copy=True)
+        values[has_link] = LINK_SENTINEL
+        cells[col_link] = values
+    formula = np.full(len(frame), -1)
+    for i, (_, rows) in enumerate(plan.programs):
+        formula[rows] = i
+    cells["__formula__"] = formula[positions]
+    codes, _ = pd.factorize(pd.util.hash_pandas_object(cells, index=False).to_numpy())
+    first = np.unique(codes, return_index=True)[1]
+
+    content = compute_content(plan, cells.iloc[first].drop(columns="__formula__"), positions[first])
+    texts = content.where(content.notna(), "").astype(str)
+    spliced = texts.str.count(LINK_SENTINEL).to_numpy()[codes]
+    ucs2, gsm_units, ucs2_units = (a[codes] for a in text_units(texts.str.replace(LINK_SENTINEL, "", regex=False)))
+
+    if has_link.any():
+        link_ucs2, link_gsm, link_ucs2_units = text_units(links[positions[has_link]])
+        k = spliced[has_link]
+        ucs2[has_link] |= (k > 0) & link_ucs2
+        gsm_units[has_link] += k * link_gsm
+        ucs2_units[has_link] += k * link_ucs2_units
+    return units_segments(ucs2, np.where(ucs2, ucs2_units, gsm_units)).astype(np.int32)
+
+def links_digest(links):
+    """Fingerprint of a link list, used to recognise an appended re-export."""
+    h = hashlib.sha256()
+    for link in links:
+        h.update(str(link).encode("utf-8"))
+        h.update(b"\n")
+    return h.hexdigest()
+
+def _changed_groups(previous, plan, links):
+    """
+    If `links` are the previous run's links plus appended ones (same
+    template), return the groups holding newly filled rows; otherwise None.
+    """
+    fp = getattr(previous, "fingerprint", None)
+    if not fp or fp["template"] != plan.digest or not isinstance(previous, LazyGroupedResult):
+        return None
+    old_count = fp["links"]
+    if len(links) < old_count or links_digest(links[:old_count]) != fp["links_digest"]:
+        return None
+    print(f"Incremental: {len(links) - old_count} appended link(s)")
+
+    # Groups are contiguous row ranges, find the ones holding new rows
+    positions = np.flatnonzero((previous.rows >= old_count) & (previous.rows < len(links)))
+    gids = list(previous.ranges)
+    starts = np.array([previous.ranges[gid][0] for gid in gids], dtype=np.int64)
+    hit = np.unique(np.searchsorted(starts, positions, side="right") - 1)
+    return [gids[i] for i in hit]
+
+def _lazy_groups(plan, links, fingerprint, previous, recorder, registry=None, on_duplicate="flag"):
+    """Keys and counts only, group frames are built on demand (LazyGroupedResult)."""
+    template_df = plan.frame
+    cols = plan.columns
+
+    # Links are filled and 内容 computed per group when a group is read,
+    # no fill/compute_content stages here
+    recorder.begin("filter")
+    valid = template_df[[cols["lang"], cols["region"]]].notna().all(axis=1).to_numpy()
+    positions = np.flatnonzero(valid)
+    recorder.end(rows=len(positions))
+
+    duplicates = _check_links(_exported_links(links, positions), registry, on_duplicate, recorder)
+
+    recorder.begin("group")
+    col_content = cols["content"] or "Content_Calculated"
+    export_cols = [c for c in [cols["lang"], cols["region"], cols["sender"], cols["title"]] if c is not None]
+    export_cols.append(col_content)
+    order, ranges = partition_order(template_df[cols["text_id"]].to_numpy()[positions])
+    changed = _changed_groups(previous, plan, links) if previous is not None else None
+    groups = LazyGroupedResult(plan, links, positions[order], ranges, export_cols, fingerprint, changed)
+    groups.duplicates = duplicates
+    if changed is not None:
+        # Same template and links prefix: unchanged groups keep their built frames
+        for gid, frame in previous._frames.items():
+            if gid not in changed:
+                groups._cache(gid, frame)
+    recorder.end(rows=len(positions))
+
+    # SMS segments from the template text and link sizes, 内容 is not built
+    recorder.begin("segments", rows=len(positions))
+    groups.segments = _spliced_segments(plan, groups.links, groups.rows)
+    if groups.segments is None:
+        # A formula inspects the link: build 内容 block by block, not kept
+        if changed is not None and previous.segments is not None:
+            groups.segments = previous.segments.copy()
+            groups.compute_segments(changed)
+        else:
+            groups.compute_segments()
+    recorder.end()
+    return groups
+
+def _exported_links(links, positions):
+    # Links filled into the valid template rows at `positions`, the same
+    # set GroupedResult.link_groups() returns
+    return np.asarray(links, dtype=object)[positions[positions < len(links)]]
+
+def _check_links(links, registry, on_duplicate, recorder):
+    """Look `links` up in the link registry, raise DuplicateLinksError when rejecting."""
+    recorder.begin("check_links")
+    if registry is None:
+        recorder.end(rows=0)
+        return None
+    duplicates = registry.find(links)
+    recorder.end(rows=len(links))
+    if len(duplicates):
+        print(f"Registry: {len(duplicates)} link(s) were already exported")
+        if on_duplicate == "reject":
+            raise DuplicateLinksError(duplicates)
+    return duplicates
+
+def _read_source(source_file, source_format, recorder, workers=None):
+    # Only the link column is streamed out of the source.
     # User feedback: "需要合并、导出到最后output的是“短链接”那一列"
     # Prioritize "短链接" > "Short Link" > "link"
-    cols_lower = [str(c).lower() for c in source_df.columns]
-    
-    link_col = None
-    # 1. Exact match for specific Chinese term
-    for c in source_df.columns:
-        if "短链接" in str(c):
-            link_col = c
-            break
-            
-    # 2. English term if not found
-    if not link_col:
-        for c in source_df.columns:
-            if "short link" in str(c).lower():
-                link_col = c
-                break
-                
-    # 3. Fallback to generic "link"
-    if not link_col:
-        for c in source_df.columns:
-            if "link" in str(c).lower() or "链接" in str(c):
-                link_col = c
-                break
-                
-    # 4. Fallback to first column
-    if not link_col:
-        link_col = source_df.columns[0]
-
-    links = source_df[link_col].dropna().tolist()
+    recorder.begin("read_source")
+    if is_multi_source(source_file):
+        links, columns = read_links_many(source_file, source_format, workers)
+        for name, col, count in columns:
+            print(f"Source: {name}: {count} links in column '{col}'")
+        link_col = ", ".join(dict.fromkeys(str(col) for _, col, _ in columns))
+    else:
+        links, link_col = read_links(source_file, source_format)
+    recorder.end(rows=len(links))
     print(f"Source: Found {len(links)} links in column '{link_col}'")
+    return links
 
-    # 2. Read Template
-    template_df = pd.read_excel(template_file)
-    
-    # 3. Identify Template Columns
-    # Need: 正文(B), 回到提瓦特(C), 链接(D), 退订(E) -> for formula
-    # Need: 语言标识, 区域列表, 发信人/签名 -> for export
-    # Need: 文案 -> for grouping
+def build_groups(source_file, template_file, recorder=None, source_format=None, previous=None,
+                 registry=None, on_duplicate="flag", workers=None):
+    """
+    Shared pipeline: read source + template, fill links, compute 内容,
+    filter complete rows and partition by 文案.
+    The source may be xlsx, xls, csv or parquet (by extension, or `source_format`),
+    or a list / ZIP of such files, parsed on `workers` processes (default:
+    all cores, pass 1 inside a worker process) and concatenated in file
+    name order (see source_reader.read_links_many).
+    Stage timings go to `recorder` (instrument.StageRecorder) when given.
+    With `previous` (the GroupedResult of an earlier run) and the same
+    template, a source that only appends links is patched incrementally.
+    With a link_registry.LinkRegistry as `registry`, links exported by
+    earlier campaigns are listed in the result's `duplicates`
+    (on_duplicate="flag") or raise DuplicateLinksError ("reject").
+    Returns: GroupedResult of the export columns
+    """
+    if recorder is None:
+        recorder = StageRecorder()
     
-    def find_col(keywords, default_idx=None):
-        if isinstance(keywords, str): keywords = [keywords]
-        for col in template_df.columns:
-            for k in keywords:
-                if k in str(col):
-                    return col
-        if default_idx is not None and default_idx < len(template_df.columns):
-            return template_df.columns[default_idx]
-        return None
+    # 1. Read Source (allow file path or bytes)
+    links = _read_source(source_file, source_format, recorder, workers)
+    return build_template_groups(links, template_file, recorder, previous, registry, on_duplicate)
 
-    # Mapping based on user description + guessing standard names
-    col_text_id = find_col(["文案", "Text"], 0) # Grouping key
-    col_body = find_col("正文", 1)    # B
-    col_back = find_col(["回到", "提瓦特", "Back"], 2) # C
-    col_link_target = find_col("链接", 3)  # D (This is where we fill the link)
-    col_unsub = find_col("退订", 4) # E
-    
-    col_lang = find_col(["语言", "Language"])
-    col_region = find_col(["区域", "Region"])
-    col_sender = find_col(["发信人", "签名", "Sender", "Signature"])
-    col_title = find_col(["标题", "Title"])
-    col_content = find_col("内容")  # The Target Column for the formula result
+def build_template_groups(links, template_file, recorder=None, previous=None, registry=None, on_duplicate="flag"):
+    """
+    Fill already read `links` into one template and group it (build_groups
+    without the source stage).
+    """
+    if recorder is None:
+        recorder = StageRecorder()
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise ValueError(f"不支持的重复短链处理方式: {on_duplicate}")
+
+    # 2. Load the compiled Template plan
+    # Parsing, column mapping and formula compilation are cached by the
+    # template's hash, so a reused template is not parsed again.
+    recorder.begin("read_template")
+    plan = load_template_plan(template_file)
+    template_df = plan.frame
+    recorder.end(rows=len(template_df))
+    
+    
+    # 3. Template Columns (resolved by keyword in template_plan.COLUMN_RULES)
+    col_text_id = plan.columns["text_id"] # Grouping key
+    col_body = plan.columns["body"]    # B
+    col_back = plan.columns["back"] # C
+    col_link_target = plan.columns["link"]  # D (This is where we fill the link)
+    col_unsub = plan.columns["unsub"] # E
+    
+    col_lang = plan.columns["lang"]
+    col_region = plan.columns["region"]
+    col_sender = plan.columns["sender"]
+    col_title = plan.columns["title"]
+    col_content = plan.columns["content"]  # The Target Column for the formula result
     
     # Debug info
     print(f"Mapped Columns:\nBody={col_body}\nBack={col_back}\nLink={col_link_target}\nUnsub={col_unsub}\nLang={col_lang}\nRegion={col_region}\nSender={col_sender}\nTitle={col_title}\nContent={col_content}")
-    
-    if not (col_lang and col_region and col_text_id):
-        raise ValueError("无法在模板中找到关键列：文案、语言标识、区域列表。请检查模板表头。")
 
-    results = {} # Store results {filename: dataframe}
+    # Links fill the template rows 1-to-1
+    if len(links) > len(template_df):
+        print("Warning: Source has more links than Template has rows. Truncating source.")
+        links = links[:len(template_df)]
+    elif len(links) < len(template_df):
+         print("Warning: Source has fewer links than Template. Some rows will be empty.")
+    fingerprint = {"template": plan.digest, "links": len(links), "links_digest": links_digest(links)}
+
+    if plan.programs:
+        print(f"Template: Evaluating {len(plan.programs)} distinct formula(s) from column '{col_content}'")
+    # Preview-first: keys and counts now, 内容 when a group is read.
+    # A formula reading other rows needs the whole filled sheet, so it stays eager.
+    if all(is_row_local(program) for program, _ in plan.programs):
+        return _lazy_groups(plan, links, fingerprint, previous, recorder, registry, on_duplicate)
 
     # 4. Fill and Compute
     # Since we need to fill "in order", we repeat the template logic for each link?
@@ -123,34 +579,17 @@ def process_excel_cloud(source_file, template_file, output_dir=None):
     # This implies splitting the result by ID.
     
     # Let's try filling the `col_link_target` column with the `links` list.
+    recorder.begin("fill")
     filled_df = template_df.copy()
     
-    # Ensure dataframe is long enough?
-    if len(links) > len(filled_df):
-        print("Warning: Source has more links than Template has rows. Truncating source.")
-        links = links[:len(filled_df)]
-    elif len(links) < len(filled_df):
-         print("Warning: Source has fewer links than Template. Some rows will be empty.")
-    
     # Update the Link Column
     # We only update rows where we have links.
     filled_df.loc[:len(links)-1, col_link_target] = links
+    recorder.end(rows=len(links))
     
-    # 5. Compute Formula: =B2&CHAR(10)&C2&D2&" "&CHAR(10)&E2
-    # Vectorized computation
-    def get_str(col):
-        if col: return filled_df[col].fillna("").astype(str)
-        return pd.Series([""] * len(filled_df))
-
-    b_val = get_str(col_body)
-    c_val = get_str(col_back)
-    d_val = get_str(col_link_target) # The links we just filled
-    e_val = get_str(col_unsub)
-    
-    # Formula logic
-    # B + \n + C + D + " " + \n + E
-    newline = "\n"
-    computed_content = b_val + newline + c_val + d_val + " " + newline + e_val
+    # 5. Compute 内容
+    recorder.begin("compute_content", rows=len(filled_df))
+    computed_content = compute_content(plan, filled_df)
     
     # Store result in `col_content`
     if col_content:
@@ -158,137 +597,279 @@ def process_excel_cloud(source_file, template_file, output_dir=None):
     else:
         filled_df["Content_Calculated"] = computed_content
         col_content = "Content_Calculated"
+    recorder.end()
         
-    # 6. Filter and Export
+    # 6. Filter and Group
     # Condition: Language & Region must be complete (not null)
+    recorder.begin("filter")
     valid_rows = filled_df.dropna(subset=[col_lang, col_region])
+    recorder.end(rows=len(valid_rows))
     
-    # Group by Text ID (文案)
-    groups = valid_rows[col_text_id].unique()
+    # Only the links of exported rows are checked against the registry
+    duplicates = _check_links(_exported_links(links, valid_rows.index.to_numpy()), registry, on_duplicate, recorder)
     
-    generated_files = {} # path -> dataframe
+    # Columns to export: Language, Region, Sender, Title, Content
+    export_cols = [c for c in [col_lang, col_region, col_sender, col_title, col_content] if c is not None]
     
-    for gid in groups:
-        subset = valid_rows[valid_rows[col_text_id] == gid]
-        if subset.empty: continue
-        
-        # Columns to export: Language, Region, Sender, Title, Content
-        export_cols = [c for c in [col_lang, col_region, col_sender, col_title, col_content] if c is not None]
-        
-        final_data = subset[export_cols]
-        
-        # Determine filename
-        fname = f"output_group_{gid}.xlsx"
-        if output_dir:
-            fpath = os.path.join(output_dir, fname)
-            final_data.to_excel(fpath, index=False)
-            generated_files[fname] = fpath
+    # Group by Text ID (文案)
+    # One compact backing frame for all groups
+    recorder.begin("group")
+    export_frame = compact_frame(valid_rows[export_cols], skip={col_content})
+    ordered, ranges = partition_ranges(export_frame, valid_rows[col_text_id])
+    groups = GroupedResult(ordered, ranges, fingerprint, links=links)
+    groups.duplicates = duplicates
+    recorder.end(rows=len(valid_rows))
+    
+    # 7. SMS segments (GSM-7 / UCS-2) of every 内容, billed per segment
+    recorder.begin("segments", rows=len(ordered))
+    groups.compute_segments()
+    recorder.end()
+    
+    return groups
+
+def template_names(template_files):
+    """Output namespace per template: the file name stem, made unique with _2, _3..."""
+    names = []
+    for idx, template_file in enumerate(template_files):
+        label = getattr(template_file, "name", None) or (
+            template_file if isinstance(template_file, (str, os.PathLike)) else "")
+        base = os.path.splitext(os.path.basename(os.fspath(label)))[0] or f"template_{idx + 1}"
+        name, k = base, 1
+        while name in names:
+            k += 1
+            name = f"{base}_{k}"
+        names.append(name)
+    return names
+
+class _PrefetchedRegistry:
+    """Registry lookups answered from one find() over the whole source."""
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+
+    def find(self, links):
+        wanted = pd.Series(links, dtype=object).dropna().astype(str)
+        hit = self.duplicates["link"].isin(wanted)
+        return self.duplicates[hit].reset_index(drop=True)
+
+def _template_recorder(recorder, name):
+    # A template's stages land in the shared recorder as "<name>/<stage>"
+    def forward(record):
+        record["stage"] = f"{name}/{record['stage']}"
+        recorder.records.append(record)
+        if recorder.hook is not None:
+            recorder.hook(record)
+    return StageRecorder(hook=forward)
+
+def fanout_stage_count(template_count):
+    """Most stages build_groups_many records for `template_count` templates."""
+    return 2 + template_count * (len(ANALYSIS_STAGES) - 1)
+
+def build_groups_many(source_file, template_files, recorder=None, source_format=None, workers=None,
+                      registry=None, on_duplicate="flag", read_workers=None):
+    """
+    One source, many templates (regions, festivals, A/B copy).
+    The source is read and checked against `registry` once, then every
+    template is filled, computed and grouped on a thread pool of `workers`
+    (default: one per template, at most the core count) from the same link
+    list. Template stages are recorded as "<name>/<stage>". A multi-file
+    source is parsed on `read_workers` processes (see build_groups).
+    Returns: { template name: GroupedResult } in template order
+    (see template_names)
+    """
+    if recorder is None:
+        recorder = StageRecorder()
+    names = template_names(template_files)
+    links = _read_source(source_file, source_format, recorder, read_workers)
+
+    recorder.begin("check_links")
+    if registry is not None:
+        registry = _PrefetchedRegistry(registry.find(links))
+    recorder.end(rows=len(links) if registry is not None else 0)
+
+    if workers is None:
+        workers = min(len(template_files), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="sms-template") as pool:
+        futures = [
+            pool.submit(build_template_groups, links, template_file, _template_recorder(recorder, name),
+                        registry=registry, on_duplicate=on_duplicate)
+            for name, template_file in zip(names, template_files)
+        ]
+        return {name: future.result() for name, future in zip(names, futures)}
+
+class TemplateFanout(Mapping):
+    """
+    Results of one source and several templates read as one GroupedResult:
+    keys are (template name, group_id), files are namespaced by template
+    ("<template>/output_group_1.xlsx").
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.ranges = {(name, gid): None for name, result in results.items() for gid in result}
+        self.fingerprint = None
+        self.changed = None
+        frames = [result.duplicates for result in results.values() if result.duplicates is not None]
+        self.duplicates = (pd.concat(frames).drop_duplicates("link", ignore_index=True)
+                           if len(frames) == len(results) and frames else None)
+        segments = [result.segments for result in results.values() if result.segments is not None]
+        self.segments = np.concatenate(segments) if segments else np.zeros(0, dtype=np.int32)
+
+    def __getitem__(self, key):
+        name, gid = key
+        return {"default_name": self.default_name(key), "data": self.results[name].group_frame(gid)}
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def group_label(self, key):
+        return f"{key[0]} / {key[1]}"
+
+    def default_name(self, key, fmt="xlsx"):
+        return f"{key[0]}/{default_name(key[1], fmt)}"
+
+    def row_count(self, key):
+        return self.results[key[0]].row_count(key[1])
+
+    def segment_total(self, key):
+        return self.results[key[0]].segment_total(key[1])
+
+    def group_frame(self, key):
+        return self.results[key[0]].group_frame(key[1])
+
+    def group_digest(self, key):
+        return self.results[key[0]].group_digest(key[1])
+
+    def preview(self, key, n=5):
+        return self.results[key[0]].preview(key[1], n)
+
+    def frames(self):
+        return [(key, self.group_frame(key)) for key in self.ranges]
+
+    def link_groups(self):
+        return [(f"{name}/{gid}", links) for name, result in self.results.items()
+                for gid, links in result.link_groups()]
+
+BUNDLE_NAME = "output_groups.zip"
+
+def _write_outputs(named_frames, output_dir, workers, bundle, fmt, max_rows, max_bytes, total_rows):
+    # Encode groups in parallel, results keep the group order
+    # Large groups are streamed (constant memory) by the exporter
+    # "<template>/<file>" names of a fan-out go to sub-directories / ZIP folders
+    if output_dir:
+        return dict(export_parts(named_frames, output_dir, max_rows, max_bytes, workers, fmt, total_rows))
+    if bundle:
+        # One ZIP for everything, peak memory is a single workbook
+        # (byte limits: the encoded parts in flight)
+        output = io.BytesIO()
+        if max_bytes:
+            parts = encode_parts(named_frames, max_rows, max_bytes, workers, fmt, total_rows)
         else:
-            # Memory mode for web download
-            output = io.BytesIO()
-            final_data.to_excel(output, index=False)
-            output.seek(0)
-            generated_files[fname] = output
+            parts = iter_parts(named_frames, max_rows, fmt=fmt)
+        write_zip_bundle(parts, output, fmt=fmt)
+        output.seek(0)
+        return {BUNDLE_NAME: output}
+    # Memory mode for web download
+    parts = encode_parts(named_frames, max_rows, max_bytes, workers, fmt, total_rows)
+    return {fname: io.BytesIO(data) for fname, data in parts}
+
+def _campaign_name(source_file):
+    first = source_file[0] if isinstance(source_file, (list, tuple)) else source_file
+    return os.path.basename(getattr(first, "name", None) or str(first))
+
+def process_excel_cloud(source_file, template_file, output_dir=None, workers=None, recorder=None, bundle=False,
+                        fmt="xlsx", source_format=None, max_rows=None, max_bytes=None,
+                        registry=None, campaign=None, on_duplicate="flag"):
+    """
+    Cloud-optimized Excel processor.
+    Returns a dictionary of {filename: excel_bytes} for easy download in Streamlit,
+    or saves to output_dir if provided.
+    Groups are written as `fmt` ("xlsx", "csv" or "parquet").
+    Groups over `max_rows` rows (xlsx: always over the sheet limit) or
+    `max_bytes` bytes are split into numbered part files (..._part1.xlsx).
+    Source files are read and groups and parts encoded across `workers`
+    processes (default: all cores, serial for small jobs).
+    With bundle=True (and no output_dir) all groups are streamed into one ZIP,
+    one group at a time, and {BUNDLE_NAME: zip_bytes} is returned.
+    Pass an instrument.StageRecorder as `recorder` to collect stage timings.
+    With a link_registry.LinkRegistry as `registry` the links are checked
+    before export (see build_groups) and recorded under `campaign`
+    (default: the source file name) once the files are written.
+    """
+    print("Starting Cloud Processing...")
+    if recorder is None:
+        recorder = StageRecorder()
+    result = build_groups(source_file, template_file, recorder, source_format,
+                          registry=registry, on_duplicate=on_duplicate, workers=workers)
+    
+    # Group frames are built lazily, only those in flight are held
+    named_frames = ((default_name(gid, fmt), result.group_frame(gid)) for gid in result.ranges)
+    
+    total_rows = sum(result.row_count(gid) for gid in result.ranges)
+    recorder.begin("encode", rows=total_rows)
+    generated_files = _write_outputs(named_frames, output_dir, workers, bundle, fmt, max_rows, max_bytes, total_rows)
+    recorder.end()
+
+    if registry is not None:
+        registry.record(campaign or _campaign_name(source_file), result.link_groups())
             
     return generated_files
 
-def process_excel_cloud_get_data(source_file, template_file):
+def process_excel_cloud_many(source_file, template_files, output_dir=None, workers=None, recorder=None, bundle=False,
+                             fmt="xlsx", source_format=None, max_rows=None, max_bytes=None,
+                             registry=None, campaign=None, on_duplicate="flag"):
     """
-    Step 1: Process and get dataframes and default names.
-    Returns: { group_id: { "default_name": str, "data": DataFrame } }
-    This allows the UI to ask for custom names before saving.
+    process_excel_cloud for one source and several templates (see
+    build_groups_many). Every template's files are namespaced by its name:
+    "<template>/output_group_1.xlsx" (a sub-directory of output_dir, a
+    folder in the ZIP, or the key of the returned dict).
+    Links are recorded once per campaign, with "<template>/<group>" as group.
     """
-    # Reuse logic logic from above, but split the save part
-    # ... (Duplicate code avoided by refactoring or copying essential parts)
-    # Ideally we refactor `process_excel_cloud` to call `process_excel_cloud_get_data`
-    pass
-    
-    # RE-IMPLEMENTING logic to avoid code duplication issues with tools
-    # Start of logic needed for data generation
-    source_df = pd.read_excel(source_file)
-    cols_lower = [str(c).lower() for c in source_df.columns]
-    link_col = None
-    for c in source_df.columns:
-        if "短链接" in str(c):
-            link_col = c
-            break
-    if not link_col:
-        for c in source_df.columns:
-            if "short link" in str(c).lower():
-                link_col = c
-                break
-    if not link_col:
-        for c in source_df.columns:
-            if "link" in str(c).lower() or "链接" in str(c):
-                link_col = c
-                break
-    if not link_col: link_col = source_df.columns[0]
-    links = source_df[link_col].dropna().tolist()
-
-    template_df = pd.read_excel(template_file)
-    
-    def find_col(keywords, default_idx=None):
-        if isinstance(keywords, str): keywords = [keywords]
-        for col in template_df.columns:
-            for k in keywords:
-                if k in str(col): return col
-        if default_idx is not None and default_idx < len(template_df.columns): return template_df.columns[default_idx]
-        return None
+    print("Starting Cloud Processing...")
+    if recorder is None:
+        recorder = StageRecorder()
+    fanout = TemplateFanout(build_groups_many(source_file, template_files, recorder, source_format,
+                                              registry=registry, on_duplicate=on_duplicate,
+                                              read_workers=workers))
 
-    col_text_id = find_col(["文案", "Text"], 0)
-    col_body = find_col("正文", 1)
-    col_back = find_col(["回到", "提瓦特", "Back"], 2)
-    col_link_target = find_col("链接", 3)
-    col_unsub = find_col("退订", 4)
-    
-    col_lang = find_col(["语言", "Language"])
-    col_region = find_col(["区域", "Region"])
-    col_sender = find_col(["发信人", "签名", "Sender", "Signature"])
-    col_title = find_col(["标题", "Title"])
-    col_content = find_col("内容")
-    
-    if not (col_lang and col_region and col_text_id):
-        raise ValueError("无法在模板中找到关键列：文案、语言标识、区域列表")
+    named_frames = ((fanout.default_name(key, fmt), fanout.group_frame(key)) for key in fanout.ranges)
 
-    filled_df = template_df.copy()
-    if len(links) > len(filled_df): links = links[:len(filled_df)]
-    filled_df.loc[:len(links)-1, col_link_target] = links
-    
-    def get_str(col):
-        if col: return filled_df[col].fillna("").astype(str)
-        return pd.Series([""] * len(filled_df))
+    total_rows = sum(fanout.row_count(key) for key in fanout.ranges)
+    recorder.begin("encode", rows=total_rows)
+    generated_files = _write_outputs(named_frames, output_dir, workers, bundle, fmt, max_rows, max_bytes, total_rows)
+    recorder.end()
 
-    b_val = get_str(col_body)
-    c_val = get_str(col_back)
-    d_val = get_str(col_link_target)
-    e_val = get_str(col_unsub)
-    newline = "\n"
-    computed_content = b_val + newline + c_val + d_val + " " + newline + e_val
-    
-    if col_content: filled_df[col_content] = computed_content
-    else:
-        filled_df["Content_Calculated"] = computed_content
-        col_content = "Content_Calculated"
-        
-    valid_rows = filled_df.dropna(subset=[col_lang, col_region])
-    groups = valid_rows[col_text_id].unique()
-    
-    result_data = {}
-    
-    for gid in groups:
-        subset = valid_rows[valid_rows[col_text_id] == gid]
-        if subset.empty: continue
-        export_cols = [c for c in [col_lang, col_region, col_sender, col_title, col_content] if c is not None]
-        final_data = subset[export_cols]
-        
-        result_data[gid] = {
-            "default_name": f"output_group_{gid}.xlsx",
-            "data": final_data
-        }
-            
-    return result_data
+    if registry is not None:
+        registry.record(campaign or _campaign_name(source_file), fanout.link_groups())
+
+    return generated_files
+
+def process_excel_cloud_get_data(source_file, template_file, recorder=None, source_format=None, previous=None,
+                                 registry=None, on_duplicate="flag"):
+    """
+    Step 1: Process and get dataframes and default names.
+    Returns: GroupedResult, read like { group_id: { "default_name": str, "data": DataFrame } }
+    This allows the UI to ask for custom names before saving.
+    Pass an instrument.StageRecorder as `recorder` to collect stage timings.
+    Pass the previous result as `previous` to patch appended links incrementally.
+    Pass a link_registry.LinkRegistry as `registry` to check for reused links.
+    """
+    return build_groups(source_file, template_file, recorder, source_format, previous, registry, on_duplicate)
     # Test
     src = r"d:/短信/20260130_海灯节/short-link-admin_download_task1391718_result.xlsx"
     tpl = r"d:/短信/20260130_海灯节/test.xlsx"
     out = r"d:/Antigravity/projects/output_cloud"
     process_excel_cloud(src, tpl, out)
+
+def process_excel_cloud_get_data_many(source_file, template_files, recorder=None, source_format=None,
+                                      registry=None, on_duplicate="flag"):
+    """
+    Step 1 for one source and several templates.
+    Returns: TemplateFanout keyed by (template name, group_id), the
+    per-template GroupedResults are in its `results` (see build_groups_many)
+    """
+    return TemplateFanout(build_groups_many(source_file, template_files, recorder, source_format,
+                                            registry=registry, on_duplicate=on_duplicate))
@@ -1,15 +1,90 @@
+import numpy as np
 import pandas as pd
 import os
 
-def process_excel_pure_python(source_path, template_path, output_dir):
+try:
+    from sms_segments import count_segments
+except ImportError:
+    from core_logic.sms_segments import count_segments
+
+def _prepare_template(template_df):
+    """
+    补齐模板列并预先计算公式中不随链接变化的部分。
+    公式 =B & \n & C & D & " " & \n & E 中只有 D (链接) 会变，
+    因此 B & \n & C 和 " " & \n & E 只需按模板行计算一次。
+    Returns: (template_df, col_d, prefix, suffix)
+    """
+    template_df = template_df.copy()
+    
+    # 确保列存在，如果不够则补齐
+    while len(template_df.columns) < 5:
+        template_df[f'Unnamed_{len(template_df.columns)}'] = ""
+
+    # 获取列名以便引用
+    col_b = template_df.columns[1] # 正文
+    col_c = template_df.columns[2] # 链接前缀?
+    col_d = template_df.columns[3] # 链接坑位 (Target)
+    col_e = template_df.columns[4] # 链接后缀?
+    
+    # 注意处理 NaN 为空字符串
+    part_b = template_df[col_b].fillna("").astype(str)
+    part_c = template_df[col_c].fillna("").astype(str)
+    part_e = template_df[col_e].fillna("").astype(str)
+    
+    prefix = (part_b + "\n" + part_c).to_numpy(dtype=object)
+    suffix = (" " + "\n" + part_e).to_numpy(dtype=object)
+    return template_df, col_d, prefix, suffix
+
+def expand_links(template_df, links):
+    """
+    将每个链接与整份模板做笛卡尔积 (链接优先顺序, 与逐个复制模板再 concat 的结果一致)，
+    用一次 np.tile / np.repeat 广播完成，并一次性计算 __Calculated_Content__。
+    """
+    template_df, col_d, prefix, suffix = _prepare_template(template_df)
+    n_rows = len(template_df)
+    links = np.asarray(links, dtype=object)
+    
+    # 模板行号重复 len(links) 次, 每个链接重复 n_rows 次
+    row_idx = np.tile(np.arange(n_rows), len(links))
+    link_values = np.repeat(links, n_rows)
+    
+    full_df = template_df.iloc[row_idx].reset_index(drop=True)
+    full_df[col_d] = link_values
+    
+    # 模拟公式: =B & \n & C & D & " " & \n & E
+    link_text = pd.Series(link_values, dtype=object).fillna("").astype(str)
+    generated_content = prefix[row_idx] + link_text.to_numpy(dtype=object) + suffix[row_idx]
+    full_df['__Calculated_Content__'] = generated_content
+    full_df['__Calculated_Length__'] = full_df['__Calculated_Content__'].str.len()
+    
+    # 与原逻辑保持一致: 补齐到 H-L 列 (Index 7-11)
+    while len(full_df.columns) <= 11:
+        full_df[f'Col_{len(full_df.columns)}'] = None
+    
+    # 计费条数 (GSM-7 / UCS-2 分段), 整列一次计算
+    # 放在补齐之后, 否则窄模板的 H-L 列会把它当成导出列
+    full_df['__Segments__'] = count_segments(generated_content)
+    
+    return full_df
+
+def iter_expanded_chunks(template_df, links, chunk_links=1000):
+    """
+    分块版本的 expand_links: 每次只展开 chunk_links 个链接，
+    产出 (chunk_links × 模板行数) 的 DataFrame，内存占用与总链接数无关。
+    """
+    for start in range(0, len(links), chunk_links):
+        yield expand_links(template_df, links[start:start + chunk_links])
+
+def process_excel_pure_python(source_path, template_path, output_dir, chunk_links=None):
     """
     使用 Pure Python (Pandas) 处理 Excel，无需安装 Excel 软件。
     逻辑：
     1. 读取源文件 (获取链接)
     2. 读取模板文件 (获取固定文案)
-    3. 循环将链接填入模板 (内存中操作)
+    3. 将链接 × 模板一次性展开 (内存中操作)
     4. 模拟公式计算: =B2&CHAR(10)&C2&D2&" "&CHAR(10)&E2
     5. 导出结果
+    chunk_links: 设置后每次只展开这么多个链接并分块导出 (part 文件)，适合超大活动。
     """
     print(f"开始处理 (Cloud Mode)...\n源文件: {source_path}\n模板: {template_path}")
     
@@ -41,108 +116,19 @@ def process_excel_pure_python(source_path, template_path, output_dir):
         
         print(f"关键列: 语言={lang_col_name}, 区域={region_col_name}, 文案ID={text_id_col_name}")
         
-        master_results = []
+        # 4. 链接 × 模板 一次性展开 (不再逐个链接复制模板)
+        if chunk_links:
+            chunks = iter_expanded_chunks(template_df, links, chunk_links)
+        else:
+            chunks = [expand_links(template_df, links)]
 
-        # 4. 循环处理每个链接
-        for link in links:
-            # 复制一份模板
-            current_df = template_df.copy()
-            
-            # 填入链接到 D 列 (Index 3)
-            # 注意：如果 template_df 原本没有 D 列，需要创建
-            # 最好通过列名操作，但这里我们根据公式位置操作
-            
-            # 确保列存在，如果不够则补齐
-            while len(current_df.columns) < 5:
-                current_df[f'Unnamed_{len(current_df.columns)}'] = ""
-
-            # 获取列名以便引用
-            col_b = current_df.columns[1] # 正文
-            col_c = current_df.columns[2] # 链接前缀?
-            col_d = current_df.columns[3] # 链接坑位 (Target)
-            col_e = current_df.columns[4] # 链接后缀?
-            
-            # 填入链接
-            current_df[col_d] = link
-            
-            # 模拟公式: =B & \n & C & D & " " & \n & E
-            # 注意处理 NaN 为空字符串
-            part_b = current_df[col_b].fillna("").astype(str)
-            part_c = current_df[col_c].fillna("").astype(str)
-            part_d = current_df[col_d].fillna("").astype(str)
-            part_e = current_df[col_e].fillna("").astype(str)
-            
-            # 构造内容
-            # CHAR(10) is newline \n
-            # Logic: B + \n + C + D + " " + \n + E
-            # 注意：Excel 的 & 是强制连接
-            
-            # 我们可以创建一个新列 'GeneratedContent'
-            generated_content = (
-                part_b + "\n" + 
-                part_c + 
-                part_d + " " + "\n" + 
-                part_e
-            )
-            
-            # 将计算结果填入？用户说导出 H-L 列
-            # 假设结果应该在原来的某个位置，或者我们需要把它放到 H-L 中的某一列
-            # 由于不知道 H-L 具体是啥，我们假设 H-L 是公式计算结果所在的区域
-            # H=7, I=8, J=9, K=10, L=11
-            
-            # 如果模板里 H 列本来就是空的或者放公式的，我们把 result 放进去？
-            # 暂时我们将生成的 Content 覆盖到 H 列 (假设)，Length 覆盖到 I 列 (假设)
-            # 或者我们简单地把 GeneratedContent 添加到 DataFrame，然后在导出时放在正确位置
-            
-            current_df['__Calculated_Content__'] = generated_content
-            current_df['__Calculated_Length__'] = generated_content.str.len()
-            
-            # *重要猜测*: 用户的模板里，公式可能就在 H 列或 L 列？
-            # 既然是 "导出 test excel 中的 H-L 列"，说明 H-L 列包含了我们需要的所有信息
-            # 且 H-L 列里的数据是基于公式生成的
-            # 在 Pandas 里，我们无法"覆盖"公式列让它自己变，我们必须知道公式列是哪一列
-            
-            # 策略：如果无法确定 H-L 具体是哪几列，我们尽量保留原数据，并将计算结果附加上
-            # 但用户明确要求导出 H-L
-            
-            # 让我们尝试把计算结果写入到 H 列 (Index 7) 和 I 列 (Index 8)
-            # 如果 DataFrame 不够宽，就补齐
-            while len(current_df.columns) <= 11:
-                current_df[f'Col_{len(current_df.columns)}'] = None
-                
-            cols = current_df.columns
-            # 假设 H 列 (Index 7) 是内容? 
-            # 假设 I 列 (Index 8) 是长度?
-            # 这是一个风险点，但根据 "生成相应单元格内容" 和 "导出 H-L"，我们必须把计算值放进去
-            
-            # 我们可以把计算出的 Content 填入某个列
-            # 也许 H-L 列引用了 A-E 列？
-            # 如果我们只是修改了 A-E (主要是 D)，H-L 里的公式在 Python 里不会自动更新
-            # 所以我们需要手动更新 H-L
-            
-            # 鉴于信息有限，我将把计算出的 Content 和 Length 放在最后，
-            # 并同时导出 H-L (原本的列) + 新计算的列，供用户检查
-            # 另外，如果 columns[7] (H) 是空的或看起来像公式，我们尝试填入
-            
-            # 这里做一个大胆假设：用户需要的是我们生成的内容
-            # 我会把 __Calculated_Content__ 作为一个明确的列
-            
-            master_results.append(current_df)
-
-        # 合并所有结果
-        full_df = pd.concat(master_results, ignore_index=True)
-        
         # 5. 过滤和导出
-        # "当语言标识、区域列表这两列中的单元格是完整的时候"
-        if lang_col_name and region_col_name:
-            full_df = full_df.dropna(subset=[lang_col_name, region_col_name])
-            
         # "分别导出... 文案列标注为1的... 2的"
         # 导出 H-L 列 (Index 7 to 12, exclusive) -> 7,8,9,10,11
         # 还要包含我们计算出的新列，以防 H-L 没更新
         
         # 定义导出器
-        def export_group(group_id):
+        def export_group(full_df, group_id, part=None):
             subset = full_df[full_df[text_id_col_name] == group_id]
             if subset.empty:
                 return
@@ -159,13 +145,24 @@ def process_excel_pure_python(source_path, template_path, output_dir):
             # 添加计算列，方便用户
             final_data['Calculated_Content (Python)'] = subset['__Calculated_Content__']
             final_data['Calculated_Length (Python)'] = subset['__Calculated_Length__']
+            final_data['Segments (Python)'] = subset['__Segments__']
             
-            save_path = os.path.join(output_dir, f"cloud_output_group_{group_id}.xlsx")
+            if part is None:
+                save_path = os.path.join(output_dir, f"cloud_output_group_{group_id}.xlsx")
+            else:
+                save_path = os.path.join(output_dir, f"cloud_output_group_{group_id}_part{part}.xlsx")
             final_data.to_excel(save_path, index=False)
             print(f"导出: {save_path}")
 
-        export_group(1)
-        export_group(2)
+        for part, full_df in enumerate(chunks, start=1):
+            # "当语言标识、区域列表这两列中的单元格是完整的时候"
+            if lang_col_name and region_col_name:
+                full_df = full_df.dropna(subset=[lang_col_name, region_col_name])
+            
+            # 分块模式下每块单独导出为 part 文件，内存只保留一块
+            part_no = part if chunk_links else None
+            export_group(full_df, 1, part_no)
+            export_group(full_df, 2, part_no)
         
         print("处理完成 (Python Mode)!")
 
@@ -0,0 +1,95 @@
+"""
+Vectorized SMS segment counting.
+
+A message is sent as GSM-7 when every character is in the GSM 03.38 basic
+set or its extension table (extension characters take two septets), and
+as UCS-2 otherwise (characters outside the BMP take two UTF-16 units).
+    GSM-7: 160 septets in a single SMS, 153 per segment when concatenated
+    UCS-2:  70 units in a single SMS,    67 per segment when concatenated
+
+All messages are classified at once: the texts are joined, encoded to
+UTF-32 and every code point is looked up in a small table with numpy, then
+reduced per message, so there is no per-row Python loop.
+"""
+import numpy as np
+import pandas as pd
+
+GSM7_BASIC = (
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENSION = "\f^{}\\[~]|€"
+
+GSM7_SINGLE, GSM7_CONCAT = 160, 153
+UCS2_SINGLE, UCS2_CONCAT = 70, 67
+
+# Code point classes: 0 = GSM-7 basic, 1 = GSM-7 extension, 2 = UCS-2 only
+_TABLE_SIZE = max(map(ord, GSM7_BASIC + GSM7_EXTENSION)) + 1
+_CLASS = np.full(_TABLE_SIZE, 2, dtype=np.int8)
+_CLASS[[ord(c) for c in GSM7_BASIC]] = 0
+_CLASS[[ord(c) for c in GSM7_EXTENSION]] = 1
+
+
+def _texts(values):
+    texts = pd.Series(values, dtype=object, copy=False)
+    return texts.where(texts.notna(), "").astype(str).to_numpy(dtype=object)
+
+
+def text_units(values):
+    """
+    Size of every text in `values` under both encodings.
+    Returns: (ucs2, gsm_units, ucs2_units) int/bool ndarrays, `ucs2` is
+    True for texts with a character outside GSM-7
+    """
+    texts = _texts(values)
+    n = len(texts)
+    lengths = np.fromiter((len(t) for t in texts), dtype=np.int64, count=n)
+
+    ucs2 = np.zeros(n, dtype=bool)
+    extension = np.zeros(n, dtype=np.int64)
+    astral = np.zeros(n, dtype=np.int64)
+    if lengths.sum():
+        codes = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32)
+        classes = np.where(codes < _TABLE_SIZE, _CLASS[np.minimum(codes, _TABLE_SIZE - 1)], 2)
+
+        # Reduce per message; reduceat needs non-empty slices, empty
+        # messages are masked out afterwards
+        nonempty = lengths > 0
+        starts = (np.cumsum(lengths) - lengths)[nonempty]
+        ucs2[nonempty] = np.maximum.reduceat(classes, starts) == 2
+        extension[nonempty] = np.add.reduceat((classes == 1).astype(np.int64), starts)
+        astral[nonempty] = np.add.reduceat((codes > 0xFFFF).astype(np.int64), starts)
+
+    return ucs2, lengths + extension, lengths + astral
+
+
+def units_segments(ucs2, units):
+    """Billed SMS segments of messages of `units` septets / UTF-16 units."""
+    single = np.where(ucs2, UCS2_SINGLE, GSM7_SINGLE)
+    concat = np.where(ucs2, UCS2_CONCAT, GSM7_CONCAT)
+    return np.where(units <= single, (units > 0).astype(np.int64), -(-units // concat))
+
+
+def classify_segments(values):
+    """
+    Classify every message in `values` (iterable of text, NaN = empty).
+    Returns a DataFrame with one row per message:
+        encoding   "GSM-7" / "UCS-2"
+        units      septets (GSM-7) or UTF-16 code units (UCS-2)
+        segments   billed SMS segments, 0 for an empty message
+    """
+    index = values.index if isinstance(values, pd.Series) else None
+    ucs2, gsm_units, ucs2_units = text_units(values)
+    units = np.where(ucs2, ucs2_units, gsm_units)
+    segments = units_segments(ucs2, units)
+
+    return pd.DataFrame({
+        "encoding": np.where(ucs2, "UCS-2", "GSM-7"),
+        "units": units,
+        "segments": segments,
+    }, index=index)
+
+
+def count_segments(values):
+    """Billed SMS segments per message (int ndarray), see classify_segments."""
+    return classify_segments(values)["segments"].to_numpy()
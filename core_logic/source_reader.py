@@ -0,0 +1,318 @@
+import csv
+import io
+import os
+import re
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from openpyxl import load_workbook
+
+
+# Source formats, picked by file extension unless given explicitly
+SOURCE_FORMATS = ("xlsx", "xls", "csv", "parquet")
+
+# Short-link platforms export CSV as UTF-8, often with a BOM
+CSV_ENCODING = "utf-8-sig"
+
+# Below this many bytes in total, several sources are read serially
+PARALLEL_MIN_BYTES = 4 * 1024 * 1024
+
+# A source file inside a ZIP archive on disk, read by the worker itself
+ZipMember = namedtuple("ZipMember", ["archive", "member"])
+
+
+def find_link_column(headers):
+    """
+    Resolve the link column from a header row.
+    Priority: "短链接" > "Short Link" > "link"/"链接" > first column.
+    Returns the column index.
+    """
+    names = ["" if h is None else str(h) for h in headers]
+
+    # 1. Exact match for specific Chinese term
+    for idx, name in enumerate(names):
+        if "短链接" in name:
+            return idx
+
+    # 2. English term if not found
+    for idx, name in enumerate(names):
+        if "short link" in name.lower():
+            return idx
+
+    # 3. Fallback to generic "link"
+    for idx, name in enumerate(names):
+        if "link" in name.lower() or "链接" in name:
+            return idx
+
+    # 4. Fallback to first column
+    return 0
+
+
+def _source_name(source_file):
+    if isinstance(source_file, (str, os.PathLike)):
+        return os.fspath(source_file)
+    return getattr(source_file, "name", "") or ""
+
+
+def _rewind(source_file):
+    if hasattr(source_file, "seek"):
+        source_file.seek(0)
+
+
+def source_format(source_file, fmt=None):
+    """Resolve the source format: explicit `fmt`, else the file extension, else xlsx."""
+    if fmt is None:
+        ext = os.path.splitext(_source_name(source_file))[1].lower().lstrip(".")
+        fmt = ext if ext in SOURCE_FORMATS else "xlsx"
+    fmt = fmt.lower().lstrip(".")
+    if fmt not in SOURCE_FORMATS:
+        raise ValueError(f"不支持的源文件格式: {fmt}（支持 {', '.join(SOURCE_FORMATS)}）")
+    return fmt
+
+
+def _stream_link_column(source_file, fmt=None):
+    """
+    Stream the link column of a short-link export.
+    Only the header row is scanned to resolve the link column, then that
+    single column is read row by row, so memory stays flat for large files.
+    The first item yielded is the column name, followed by the non-empty links.
+    """
+    fmt = source_format(source_file, fmt)
+    if fmt == "xls":
+        # openpyxl cannot read legacy .xls, read only the link column via pandas
+        yield from _stream_link_column_pandas(source_file)
+        return
+    if fmt == "csv":
+        yield from _stream_link_column_csv(source_file)
+        return
+    if fmt == "parquet":
+        yield from _stream_link_column_parquet(source_file)
+        return
+
+    _rewind(source_file)
+    wb = load_workbook(source_file, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        # Some exporters write a bogus <dimension>, don't trust it
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return
+        idx = find_link_column(header)
+        yield header[idx]
+        for row in rows:
+            if idx >= len(row):
+                continue
+            value = row[idx]
+            if value is None or value == "":
+                continue
+            yield value
+    finally:
+        wb.close()
+
+
+def _stream_link_column_pandas(source_file):
+    import pandas as pd
+
+    _rewind(source_file)
+    header = pd.read_excel(source_file, nrows=0).columns
+    if len(header) == 0:
+        return
+    idx = find_link_column(list(header))
+    yield header[idx]
+    _rewind(source_file)
+    yield from pd.read_excel(source_file, usecols=[idx]).iloc[:, 0].dropna()
+
+
+def _stream_link_column_csv(source_file):
+    # csv module, one row at a time; only the link field is kept
+    if isinstance(source_file, (str, os.PathLike)):
+        text = open(source_file, "r", encoding=CSV_ENCODING, newline="")
+        owned = True
+    else:
+        _rewind(source_file)
+        text = io.TextIOWrapper(source_file, encoding=CSV_ENCODING, newline="")
+        owned = False
+    try:
+        rows = csv.reader(text)
+        header = next(rows, None)
+        if not header:
+            return
+        idx = find_link_column(header)
+        yield header[idx]
+        for row in rows:
+            if idx >= len(row):
+                continue
+            value = row[idx].strip()
+            if value:
+                yield value
+    finally:
+        if owned:
+            text.close()
+        else:
+            # Leave the caller's file object open
+            text.detach()
+
+
+def _stream_link_column_parquet(source_file):
+    # Columnar: resolve the link column from the schema, then read only it
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("读取 Parquet 文件需要安装 pyarrow") from e
+
+    _rewind(source_file)
+    parquet = pq.ParquetFile(source_file)
+    names = parquet.schema_arrow.names
+    if not names:
+        return
+    name = names[find_link_column(names)]
+    yield name
+    for batch in parquet.iter_batches(columns=[name], batch_size=65536):
+        for value in batch.column(0).to_pylist():
+            if value is None or value == "":
+                continue
+            yield value
+
+
+def default_workers():
+    """Worker count for reading several sources, overridable with SMS_READ_WORKERS."""
+    env = os.environ.get("SMS_READ_WORKERS")
+    if env:
+        return max(1, int(env))
+    return os.cpu_count() or 1
+
+
+def is_zip(source_file):
+    return os.path.splitext(_source_name(source_file))[1].lower() == ".zip"
+
+
+def is_multi_source(source_file):
+    """True for a list of sources or a ZIP archive of them."""
+    return isinstance(source_file, (list, tuple)) or is_zip(source_file)
+
+
+def _natural_key(name):
+    # task2 before task10
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r"(\d+)", name)]
+
+
+def _size(source_file):
+    if isinstance(source_file, (str, os.PathLike)):
+        return os.path.getsize(source_file)
+    if hasattr(source_file, "getbuffer"):
+        return len(source_file.getbuffer())
+    return 0
+
+
+def _zip_members(archive):
+    """[(name, source, size)] of the source files in a ZIP archive."""
+    on_disk = isinstance(archive, (str, os.PathLike))
+    _rewind(archive)
+    with zipfile.ZipFile(archive) as zf:
+        members = []
+        for info in zf.infolist():
+            base = os.path.basename(info.filename)
+            if info.is_dir() or info.filename.startswith("__MACOSX/") or base.startswith(("~$", ".")):
+                continue
+            if os.path.splitext(base)[1].lower().lstrip(".") not in SOURCE_FORMATS:
+                continue
+            if on_disk:
+                source = ZipMember(os.fspath(archive), info.filename)
+            else:
+                # Uploaded archive: extract here, the bytes travel to the worker
+                source = io.BytesIO(zf.read(info))
+                source.name = base
+            members.append((base, source, info.file_size))
+    return members
+
+
+def expand_sources(sources):
+    """
+    Flatten `sources` (one file, a list of files, ZIP archives of them) into
+    [(name, source, size)], ordered by file name (natural order, stable for
+    equal names) so the links are concatenated the same way however the
+    files were picked.
+    """
+    if not isinstance(sources, (list, tuple)):
+        sources = [sources]
+    items = []
+    for source in sources:
+        if is_zip(source):
+            items.extend(_zip_members(source))
+        else:
+            items.append((os.path.basename(_source_name(source)), source, _size(source)))
+    items.sort(key=lambda item: _natural_key(item[0]))
+    return items
+
+
+def _picklable(source):
+    # Worker processes get paths or bytes, never an open mapping
+    path = getattr(source, "path", None)
+    if path is not None:
+        return path
+    if hasattr(source, "getvalue") and type(source) is not io.BytesIO:
+        data = io.BytesIO(source.getvalue())
+        data.name = _source_name(source)
+        return data
+    return source
+
+
+def _read_job(job):
+    """Worker: read one source, returns (links, link_col)."""
+    source, fmt = job
+    if isinstance(source, ZipMember):
+        with zipfile.ZipFile(source.archive) as zf:
+            data = io.BytesIO(zf.read(source.member))
+        data.name = os.path.basename(source.member)
+        source = data
+    return read_links(source, fmt)
+
+
+def read_links_many(sources, fmt=None, workers=None):
+    """
+    Read and concatenate the links of several sources (see expand_sources),
+    each with its own link column. Files are parsed on a process pool
+    (`workers`, default: all cores; serial below PARALLEL_MIN_BYTES), so the
+    whole set loads in about the time of the largest file.
+    Returns: (links, [(name, link_col, link_count), ...]) in file order
+    """
+    items = expand_sources(sources)
+    if not items:
+        raise ValueError("没有找到可读取的源文件（支持 " + ", ".join(SOURCE_FORMATS) + "）")
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(items))
+
+    if workers <= 1 or sum(size for _, _, size in items) < PARALLEL_MIN_BYTES:
+        results = [_read_job((source, fmt)) for _, source, _ in items]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_read_job, [(_picklable(source), fmt) for _, source, _ in items]))
+
+    links = []
+    columns = []
+    for (name, _, _), (part, link_col) in zip(items, results):
+        links.extend(part)
+        columns.append((name, link_col, len(part)))
+    return links, columns
+
+
+def iter_links(source_file, fmt=None):
+    """Yield the non-empty links of the source file one by one."""
+    stream = _stream_link_column(source_file, fmt)
+    next(stream, None)
+    yield from stream
+
+
+def read_links(source_file, fmt=None):
+    """
+    Read all links from the source file (xlsx, xls, csv or parquet, by
+    extension unless `fmt` is given).
+    Returns: (links, link_col)
+    """
+    stream = _stream_link_column(source_file, fmt)
+    link_col = next(stream, None)
+    return list(stream), link_col
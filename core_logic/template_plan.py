@@ -0,0 +1,191 @@
+"""
+Compiled template plans.
+
+A plan holds everything the pipeline needs from a template workbook: the
+parsed rows (with compact dtypes), the resolved column roles and the
+compiled 内容 formulas. Plans are cached in memory (LRU) and optionally on
+disk, keyed by the SHA-256 of the template bytes, so reusing a template
+skips parsing entirely.
+"""
+import hashlib
+import io
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+try:
+    from formula import compile_content_formulas
+except ImportError:
+    from core_logic.formula import compile_content_formulas
+
+
+# Bump when the plan layout changes so stale disk entries are ignored
+PLAN_VERSION = 1
+
+# Keyword rules: role -> (keywords, fallback column index)
+# Need: 正文(B), 回到提瓦特(C), 链接(D), 退订(E) -> for formula
+# Need: 语言标识, 区域列表, 发信人/签名 -> for export
+# Need: 文案 -> for grouping
+COLUMN_RULES = {
+    "text_id": (["文案", "Text"], 0),  # Grouping key
+    "body": (["正文"], 1),  # B
+    "back": (["回到", "提瓦特", "Back"], 2),  # C
+    "link": (["链接"], 3),  # D (This is where we fill the link)
+    "unsub": (["退订"], 4),  # E
+    "lang": (["语言", "Language"], None),
+    "region": (["区域", "Region"], None),
+    "sender": (["发信人", "签名", "Sender", "Signature"], None),
+    "title": (["标题", "Title"], None),
+    "content": (["内容"], None),  # The Target Column for the formula result
+}
+
+
+def find_col(columns, keywords, default_idx=None):
+    if isinstance(keywords, str): keywords = [keywords]
+    for col in columns:
+        for k in keywords:
+            if k in str(col):
+                return col
+    if default_idx is not None and default_idx < len(columns):
+        return columns[default_idx]
+    return None
+
+
+def resolve_columns(columns):
+    """Map every role in COLUMN_RULES to a template column (or None)."""
+    columns = list(columns)
+    return {role: find_col(columns, keywords, default_idx)
+            for role, (keywords, default_idx) in COLUMN_RULES.items()}
+
+
+def compact_frame(frame, skip=()):
+    """Store repeated text columns as categoricals (dictionary-encoded)."""
+    frame = frame.copy()
+    for col in frame.columns:
+        if col in skip or not pd.api.types.is_string_dtype(frame[col]):
+            continue
+        values = frame[col]
+        if values.nunique(dropna=True) <= len(values) // 2:
+            frame[col] = values.astype("category")
+    return frame
+
+
+class TemplatePlan:
+    """
+    Compiled template: `frame` (template rows), `columns` (role -> column name)
+    and `programs` (compiled 内容 formulas, empty if the template has none).
+    """
+
+    def __init__(self, digest, frame, columns, programs):
+        self.digest = digest
+        self.frame = frame
+        self.columns = columns
+        self.programs = programs
+
+
+def compile_template_plan(data, digest=None):
+    """Parse template bytes and compile them into a TemplatePlan."""
+    if digest is None:
+        digest = hashlib.sha256(data).hexdigest()
+
+    template_df = pd.read_excel(io.BytesIO(data))
+    columns = resolve_columns(template_df.columns)
+
+    if not (columns["lang"] and columns["region"] and columns["text_id"]):
+        raise ValueError("无法在模板中找到关键列：文案、语言标识、区域列表。请检查模板表头。")
+
+    programs = []
+    if columns["content"]:
+        content_idx = list(template_df.columns).index(columns["content"])
+        programs = compile_content_formulas(io.BytesIO(data), content_idx, len(template_df))
+
+    # The link column is filled with text later, keep it as object
+    if columns["link"] is not None:
+        template_df[columns["link"]] = template_df[columns["link"]].astype(object)
+    frame = compact_frame(template_df, skip={columns["link"], columns["content"]})
+
+    return TemplatePlan(digest, frame, columns, programs)
+
+
+def _read_bytes(template_file):
+    if isinstance(template_file, (bytes, bytearray)):
+        return bytes(template_file)
+    if isinstance(template_file, (str, os.PathLike)):
+        with open(template_file, "rb") as f:
+            return f.read()
+    template_file.seek(0)
+    data = template_file.read()
+    template_file.seek(0)
+    return data
+
+
+class PlanCache:
+    """
+    LRU cache of compiled plans, keyed by template hash.
+    With `cache_dir`, plans are also pickled to disk and survive restarts.
+    """
+
+    def __init__(self, max_entries=32, cache_dir=None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _disk_path(self, digest):
+        return os.path.join(self.cache_dir, f"plan_v{PLAN_VERSION}_{digest}.pkl")
+
+    def _load_disk(self, digest):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._disk_path(digest), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+
+    def _save_disk(self, plan):
+        if not self.cache_dir:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._disk_path(plan.digest)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(plan, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def get(self, template_file):
+        data = _read_bytes(template_file)
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            plan = self._plans.get(digest)
+            if plan is not None:
+                self._plans.move_to_end(digest)
+                return plan
+
+        plan = self._load_disk(digest)
+        if plan is None:
+            plan = compile_template_plan(data, digest)
+            self._save_disk(plan)
+
+        with self._lock:
+            self._plans[digest] = plan
+            while len(self._plans) > self.max_entries:
+                self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+# Process-wide cache, on-disk layer enabled with SMS_TEMPLATE_CACHE_DIR
+_default_cache = PlanCache(cache_dir=os.environ.get("SMS_TEMPLATE_CACHE_DIR") or None)
+
+
+def load_template_plan(template_file):
+    """Return the compiled plan for a template (path, bytes or file object)."""
+    return _default_cache.get(template_file)
@@ -0,0 +1,129 @@
+"""
+Disk spooling for uploaded files.
+
+Streamlit keeps uploads in memory. Handing those buffers (or copies of
+them) to the readers keeps a second copy alive for the whole analysis, so
+uploads above SPOOL_THRESHOLD are written to a per-session temp directory
+and handed to the readers as memory-mapped files: pages come from the OS
+page cache and can be dropped under memory pressure instead of counting
+against the process heap. The directory (and any open mappings) is removed
+when the spool is garbage collected (end of the Streamlit session), when
+cleanup() is called, or at interpreter exit.
+"""
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import weakref
+
+# Uploads up to this size stay in memory
+SPOOL_THRESHOLD = int(os.environ.get("SMS_SPOOL_THRESHOLD", 8 * 1024 * 1024))
+
+
+class MappedFile(io.RawIOBase):
+    """Read-only, seekable file object backed by an mmap of `path`."""
+
+    def __init__(self, path, name=None):
+        super().__init__()
+        self.name = name or os.path.basename(path)
+        self.path = path
+        with open(path, "rb") as f:
+            # mmap keeps its own handle, the file object can be closed
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._map.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._map.read()
+        return self._map.read(size)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._map.seek(offset, whence)
+        return self._map.tell()
+
+    def tell(self):
+        return self._map.tell()
+
+    def getbuffer(self):
+        return memoryview(self._map)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # a memoryview is still exported, the mapping goes with it
+        super().close()
+
+
+def _cleanup(directory, handles):
+    for handle in handles:
+        handle.close()
+    handles.clear()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+class UploadSpool:
+    """Per-session spool directory for large uploads."""
+
+    def __init__(self, threshold=None):
+        self.threshold = SPOOL_THRESHOLD if threshold is None else threshold
+        self.directory = tempfile.mkdtemp(prefix="sms_upload_")
+        self._handles = []
+        # Runs on garbage collection or at interpreter exit, whichever is first
+        self._finalizer = weakref.finalize(self, _cleanup, self.directory, self._handles)
+        self._count = 0
+
+    def spool(self, uploaded):
+        """
+        Return a file object the readers can use: a MappedFile for large
+        uploads, an in-memory copy for small ones. Both keep the upload's name.
+        """
+        name = getattr(uploaded, "name", "") or "upload.xlsx"
+        size = getattr(uploaded, "size", None)
+        if size is None:
+            size = len(uploaded.getbuffer())
+
+        if size <= self.threshold:
+            data = io.BytesIO(uploaded.getvalue())
+            data.name = name
+            return data
+
+        # Keep the extension, the readers pick their engine by it
+        self._count += 1
+        path = os.path.join(self.directory, f"{self._count:04d}_{os.path.basename(name)}")
+        with open(path, "wb") as f:
+            f.write(uploaded.getbuffer())  # no intermediate bytes copy
+        handle = MappedFile(path, name=name)
+        self._handles.append(handle)
+        return handle
+
+    def clear(self):
+        """Release files spooled for earlier analyses of this session."""
+        for handle in self._handles:
+            handle.close()
+        self._handles.clear()
+        for fname in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, fname))
+            except OSError:
+                pass
+
+    def cleanup(self):
+        """Remove the spool directory now instead of at garbage collection."""
+        self._finalizer()
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
@@ -0,0 +1,527 @@
+"""
+Local HTTP job service for the cloud processor.
+
+Usage:
+    python service.py --port 8765 --workers 2
+
+    curl -F source=@links.xlsx -F template=@模板.xlsx http://127.0.0.1:8765/jobs
+    {"id": "3f2c...", "status": "queued", ...}
+    curl http://127.0.0.1:8765/jobs/3f2c...
+    curl -o groups.zip http://127.0.0.1:8765/jobs/3f2c.../result
+
+Endpoints:
+    POST   /jobs              multipart/form-data with
+                                source    one or more short-link exports (or a ZIP of them)
+                                template  one or more templates, several fan out and
+                                          namespace the files per template
+                              optional fields: format (xlsx/csv/parquet), max_rows,
+                              max_mb, campaign, on_duplicate (flag/reject)
+    GET    /jobs              all jobs
+    GET    /jobs/<id>         status: queued / running / done / error / cancelled
+    GET    /jobs/<id>/result  the results ZIP (409 until the job is done)
+    DELETE /jobs/<id>         cancel a queued job, or drop a finished one
+    GET    /health            worker and queue usage
+
+Jobs run on a pool of --workers processes; at most --max-queue more jobs
+wait for a worker, further submissions get 503. Uploads and results live in
+one directory per job under --work-dir and are removed --keep seconds after
+the job finished. With --registry, links are checked against and recorded
+in the link registry (see core_logic/link_registry.py). --trace-memory adds
+each stage's Python allocation peak to the job summaries (slower).
+"""
+import argparse
+import contextlib
+import email.parser
+import email.policy
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'core_logic'))
+try:
+    from processor_cloud import process_excel_cloud, process_excel_cloud_many, BUNDLE_NAME
+    from exporter import EXPORT_FORMATS
+    from instrument import StageRecorder
+    from link_registry import LinkRegistry, DUPLICATE_POLICIES
+except ImportError:
+    from core_logic.processor_cloud import process_excel_cloud, process_excel_cloud_many, BUNDLE_NAME
+    from core_logic.exporter import EXPORT_FORMATS
+    from core_logic.instrument import StageRecorder
+    from core_logic.link_registry import LinkRegistry, DUPLICATE_POLICIES
+
+RESULT_NAME = "result.zip"
+
+# Created in a job directory by whoever gets the job first: the worker
+# that starts it ("running") or a DELETE that cancels it ("cancelled")
+CLAIM_NAME = "claim"
+
+# Seconds between sweeps for expired jobs
+PRUNE_INTERVAL = 60
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+def _claim(job_dir, state):
+    """Atomically mark a job `state`, False if it was already claimed (or removed)."""
+    try:
+        fd = os.open(os.path.join(job_dir, CLAIM_NAME), os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+    except (FileExistsError, FileNotFoundError):
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(state)
+    return True
+
+
+def _claimed(job_dir):
+    try:
+        with open(os.path.join(job_dir, CLAIM_NAME)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def run_service_job(job_dir, sources, templates, options):
+    """
+    Worker process: run one job and write <job_dir>/result.zip.
+    Returns the job summary (file names in the ZIP and stage timings), or
+    None when the job was cancelled before a worker picked it up.
+    """
+    # The pool marks jobs in its call queue as running already, so the
+    # start is recorded here, where a DELETE can still win the claim
+    if not _claim(job_dir, "running"):
+        return None
+    recorder = StageRecorder(trace_memory=options.get("trace_memory", False))
+    registry = LinkRegistry(options["registry"]) if options.get("registry") else None
+    kwargs = dict(
+        # One worker per job, the service pool runs --workers jobs at once
+        workers=1,
+        recorder=recorder,
+        bundle=True,
+        fmt=options["format"],
+        max_rows=options.get("max_rows"),
+        max_bytes=options.get("max_bytes"),
+        registry=registry,
+        campaign=options.get("campaign"),
+        on_duplicate=options["on_duplicate"],
+    )
+    source = sources[0] if len(sources) == 1 else sources
+    with contextlib.redirect_stdout(io.StringIO()):
+        if len(templates) == 1:
+            files = process_excel_cloud(source, templates[0], **kwargs)
+        else:
+            files = process_excel_cloud_many(source, templates, **kwargs)
+
+    path = os.path.join(job_dir, RESULT_NAME)
+    with open(path, "wb") as f:
+        f.write(files[BUNDLE_NAME].getbuffer())
+    with zipfile.ZipFile(path) as zf:
+        names = zf.namelist()
+    return {"files": names, "stages": recorder.records}
+
+
+def parse_multipart(content_type, body):
+    """
+    Parse a multipart/form-data body with the email package.
+    Returns: ({field: str}, {field: [(filename, bytes), ...]})
+    """
+    header = b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n"
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+    if not message.is_multipart():
+        raise ValueError("请求必须是 multipart/form-data")
+
+    fields, files = {}, {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if not name:
+            continue
+        data = part.get_payload(decode=True) or b""
+        filename = part.get_filename()
+        if filename is None:
+            fields[name] = data.decode("utf-8")
+            continue
+        # Raw UTF-8 file names (curl, browsers) come back surrogate-escaped
+        with contextlib.suppress(UnicodeError):
+            filename = filename.encode("ascii", "surrogateescape").decode("utf-8")
+        files.setdefault(name, []).append((filename, data))
+    return fields, files
+
+
+def _safe_name(filename, fallback):
+    name = os.path.basename(filename.replace("\\", "/")).strip()
+    name = re.sub(r'[\x00-\x1f<>:"|?*]', "_", name)
+    if not name or name.startswith("."):
+        return fallback
+    return name
+
+
+def parse_options(fields):
+    """Validate the form fields of a submission, raises ValueError."""
+    fmt = fields.get("format", "xlsx").lower().lstrip(".")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支持的导出格式: {fmt}（支持 {', '.join(EXPORT_FORMATS)}）")
+    on_duplicate = fields.get("on_duplicate", "flag")
+    if on_duplicate not in DUPLICATE_POLICIES:
+        raise ValueError(f"不支持的重复短链处理方式: {on_duplicate}")
+    try:
+        max_rows = int(fields["max_rows"]) if fields.get("max_rows") else None
+        max_mb = float(fields["max_mb"]) if fields.get("max_mb") else None
+    except ValueError:
+        raise ValueError("max_rows / max_mb 必须是数字")
+    return {
+        "format": fmt,
+        "max_rows": max_rows or None,
+        "max_bytes": int(max_mb * 1024 * 1024) if max_mb else None,
+        "campaign": fields.get("campaign") or None,
+        "on_duplicate": on_duplicate,
+    }
+
+
+class ServiceJob:
+    def __init__(self, job_dir, files):
+        self.id = os.path.basename(job_dir)
+        self.dir = job_dir
+        self.files = files
+        self.created = time.time()
+        self.finished_at = None
+        self._status = "queued"  # queued / running / done / error / cancelled
+        self.error = None
+        self.summary = None
+        self.future = None
+
+    @property
+    def status(self):
+        if self._status == "queued" and _claimed(self.dir) == "running":
+            return "running"
+        return self._status
+
+    @property
+    def finished(self):
+        return self.status in ("done", "error", "cancelled")
+
+    def _on_done(self, future):
+        self.finished_at = time.time()
+        if future.cancelled() or future.exception() is None and future.result() is None:
+            self._status = "cancelled"
+        elif future.exception() is not None:
+            e = future.exception()
+            self.error = f"{type(e).__name__}: {e}"
+            self._status = "error"
+        else:
+            self.summary = future.result()
+            self._status = "done"
+
+    def to_dict(self, keep_seconds):
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "inputs": self.files,
+            "created": self.created,
+            "finished": self.finished_at,
+        }
+        if self.finished:
+            info["expires"] = self.finished_at + keep_seconds
+        if self.error:
+            info["error"] = self.error
+        if self.summary:
+            info.update(self.summary)
+            info["result"] = f"/jobs/{self.id}/result"
+        return info
+
+
+class JobStore:
+    """
+    Jobs of the service: a bounded process pool, a bounded queue in front
+    of it, and one directory per job that is removed `keep_seconds` after
+    the job finished.
+    """
+
+    def __init__(self, work_dir=None, workers=2, max_queue=8, keep_seconds=3600, registry=None,
+                 trace_memory=False):
+        self.owns_dir = work_dir is None
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="sms_service_")
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.workers = workers
+        self.max_queue = max_queue
+        self.keep_seconds = keep_seconds
+        self.registry = registry
+        self.trace_memory = trace_memory
+        self._pool = ProcessPoolExecutor(max_workers=workers)
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, uploads, options):
+        """
+        Store the uploaded files and queue the job.
+        `uploads` is {"source": [(filename, bytes)], "template": [...]}.
+        Raises ServiceBusy when the queue is full.
+        """
+        self.prune()
+        with self._lock:
+            active = sum(1 for job in self._jobs.values() if not job.finished)
+            if active >= self.workers + self.max_queue:
+                raise ServiceBusy(f"队列已满 ({active} 个任务进行中)")
+
+            job_dir = os.path.join(self.work_dir, uuid.uuid4().hex)
+            paths = {}
+            for kind in ("source", "template"):
+                folder = os.path.join(job_dir, kind)
+                os.makedirs(folder)
+                paths[kind] = []
+                for idx, (filename, data) in enumerate(uploads[kind], start=1):
+                    name = _safe_name(filename, f"{kind}_{idx}.xlsx")
+                    path = os.path.join(folder, name)
+                    # Same name twice: keep both, the file name order stays stable
+                    stem, ext = os.path.splitext(path)
+                    k = 1
+                    while os.path.exists(path):
+                        k += 1
+                        path = f"{stem}_{k}{ext}"
+                    with open(path, "wb") as f:
+                        f.write(data)
+                    paths[kind].append(path)
+
+            job = ServiceJob(job_dir, {kind: [os.path.basename(p) for p in paths[kind]] for kind in paths})
+            options = dict(options, registry=self.registry, trace_memory=self.trace_memory)
+            args = (run_service_job, job_dir, paths["source"], paths["template"], options)
+            try:
+                job.future = self._pool.submit(*args)
+            except BrokenProcessPool:
+                # A worker died (e.g. out of memory), the jobs it held have failed; start a new pool
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                job.future = self._pool.submit(*args)
+            job.future.add_done_callback(job._on_done)
+            self._jobs[job.id] = job
+            return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def delete(self, job_id):
+        """Cancel a queued job or drop a finished one. Returns False if running."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return True
+            # Not started yet: still in the pool's queue, or already handed
+            # to a worker process that will see the claim and skip it
+            if not job.finished and not job.future.cancel() and not _claim(job.dir, "cancelled"):
+                return False
+            del self._jobs[job_id]
+        shutil.rmtree(job.dir, ignore_errors=True)
+        return True
+
+    def prune(self):
+        cutoff = time.time() - self.keep_seconds
+        with self._lock:
+            stale = [job for job in self._jobs.values() if job.finished and job.finished_at < cutoff]
+            for job in stale:
+                del self._jobs[job.id]
+        for job in stale:
+            shutil.rmtree(job.dir, ignore_errors=True)
+        return len(stale)
+
+    def stats(self):
+        jobs = self.list()
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queued": sum(1 for job in jobs if job.status == "queued"),
+            "running": sum(1 for job in jobs if job.status == "running"),
+            "jobs": len(jobs),
+        }
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        if self.owns_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    server_version = "SmsJobService/1.0"
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message, headers=None):
+        self._send_json(status, {"error": message}, headers)
+
+    def _route(self):
+        parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+        if parts[:1] != ["jobs"] or len(parts) > 3 or (len(parts) == 3 and parts[2] != "result"):
+            return None, None
+        job_id = parts[1] if len(parts) > 1 else None
+        return job_id, len(parts) == 3
+
+    def do_GET(self):
+        self.store.prune()
+        if self.path.split("?", 1)[0].rstrip("/") == "/health":
+            self._send_json(HTTPStatus.OK, dict(self.store.stats(), status="ok"))
+            return
+        job_id, want_result = self._route()
+        keep = self.store.keep_seconds
+        if job_id is None:
+            if self.path.split("?", 1)[0].rstrip("/") == "/jobs":
+                self._send_json(HTTPStatus.OK, {"jobs": [job.to_dict(keep) for job in self.store.list()]})
+            else:
+                self._error(HTTPStatus.NOT_FOUND, "未知路径")
+            return
+        job = self.store.get(job_id)
+        if job is None:
+            self._error(HTTPStatus.NOT_FOUND, "任务不存在或已过期")
+        elif not want_result:
+            self._send_json(HTTPStatus.OK, job.to_dict(keep))
+        elif job.status != "done":
+            self._error(HTTPStatus.CONFLICT, f"任务尚未完成 ({job.status})")
+        else:
+            self._send_result(job)
+
+    def _send_result(self, job):
+        path = os.path.join(job.dir, RESULT_NAME)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            self._error(HTTPStatus.GONE, "结果已过期")
+            return
+        with f:
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.send_header("Content-Disposition", f'attachment; filename="{job.id}.zip"')
+            self.end_headers()
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0].rstrip("/") != "/jobs":
+            self._error(HTTPStatus.NOT_FOUND, "未知路径")
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self.close_connection = True
+            self._error(HTTPStatus.LENGTH_REQUIRED, "缺少 Content-Length")
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # The body can't be skipped without a length, drop the connection
+            self.close_connection = True
+            self._error(HTTPStatus.BAD_REQUEST, "Content-Length 必须是非负整数")
+            return
+        if length > self.server.max_upload_bytes:
+            self.close_connection = True
+            self._error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "上传文件过大")
+            return
+        body = self.rfile.read(length)
+
+        try:
+            fields, files = parse_multipart(self.headers.get("Content-Type", ""), body)
+            if not files.get("source") or not files.get("template"):
+                raise ValueError("需要上传 source 和 template 文件")
+            options = parse_options(fields)
+            job = self.store.create(files, options)
+        except ValueError as e:
+            self._error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        except ServiceBusy as e:
+            self._error(HTTPStatus.SERVICE_UNAVAILABLE, str(e), {"Retry-After": "30"})
+            return
+        self._send_json(HTTPStatus.ACCEPTED, job.to_dict(self.store.keep_seconds),
+                        {"Location": f"/jobs/{job.id}"})
+
+    def do_DELETE(self):
+        job_id, want_result = self._route()
+        if job_id is None or want_result:
+            self._error(HTTPStatus.NOT_FOUND, "未知路径")
+        elif self.store.delete(job_id):
+            self._send_json(HTTPStatus.OK, {"id": job_id, "deleted": True})
+        else:
+            self._error(HTTPStatus.CONFLICT, "任务正在运行，无法取消")
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class JobServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, store, max_upload_bytes=512 * 1024 * 1024, quiet=False):
+        super().__init__(address, ServiceHandler)
+        self.store = store
+        self.max_upload_bytes = max_upload_bytes
+        self.quiet = quiet
+        self._stop = threading.Event()
+        # Expired jobs are removed even while no requests come in
+        self._janitor = threading.Thread(target=self._sweep, name="sms-service-prune", daemon=True)
+        self._janitor.start()
+
+    def _sweep(self):
+        while not self._stop.wait(PRUNE_INTERVAL):
+            self.store.prune()
+
+    def server_close(self):
+        self._stop.set()
+        super().server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="短信文案分组 HTTP 任务服务 (本地)")
+    parser.add_argument("--host", default="127.0.0.1", help="bind address (default: localhost only)")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-w", "--workers", type=int, default=2, help="jobs running at the same time")
+    parser.add_argument("--max-queue", type=int, default=8, help="jobs waiting for a worker before 503")
+    parser.add_argument("--keep", type=int, default=3600, help="seconds a finished job's result is kept")
+    parser.add_argument("--work-dir", default=None, help="job directory root (default: a temp dir)")
+    parser.add_argument("--max-upload-mb", type=float, default=512, help="largest accepted request body")
+    parser.add_argument("--registry", default=None, help="link registry (SQLite) to check and record exported links in")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="record the Python allocation peak of every stage (slower)")
+    args = parser.parse_args(argv)
+
+    registry = LinkRegistry(args.registry).path if args.registry else None
+    store = JobStore(args.work_dir, args.workers, args.max_queue, args.keep, registry, args.trace_memory)
+    server = JobServer((args.host, args.port), store, int(args.max_upload_mb * 1024 * 1024))
+    print(f"服务已启动: http://{args.host}:{server.server_port} (workers={args.workers}, queue={args.max_queue})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())